@@ -0,0 +1,205 @@
+"""
+Compare the size of Conduit payloads, and the time needed to decode them.
+
+Requests are encoded as the flattened form fields moz-phab used to send, and as a
+single JSON "params" field.  Responses are measured as sent by the server, and gzip
+compressed.  Recorded responses, like the output of a `curl` call to the Conduit
+API, can be passed as arguments; a `differential.revision.search` response is
+generated otherwise, with and without the reviewers attachment:
+
+    python2 conduit_payload_benchmark.py --revisions 100
+    python2 conduit_payload_benchmark.py response.json
+"""
+
+import argparse
+import imp
+import json
+import os
+import time
+import urllib2
+import zlib
+
+mozphab = imp.load_source(
+    "mozphab", os.path.join(os.path.dirname(os.path.abspath(__file__)), "moz-phab")
+)
+
+
+def form_post_data(api_call_args, api_token):
+    """Encode the arguments as `name[key][index]=value` form fields.
+
+    A copy of `json_args_to_query_params`, and of the encoding done by
+    `ConduitAPI.call`, from before the JSON params.
+    """
+    params = []
+
+    def convert(path, v):
+        if type(v) == list:
+            for index, elem in enumerate(v):
+                convert("{}[{}]".format(path, index), elem)
+        elif type(v) == dict:
+            for key, value in v.iteritems():
+                convert("{}[{}]".format(path, key), value)
+        else:
+            params.append((path, str(v)))
+
+    for key, value in api_call_args.iteritems():
+        convert(key, value)
+    params.append(("api.token", api_token))
+    return "&".join(["{}={}".format(k, urllib2.quote(v)) for (k, v) in params])
+
+
+def search_response(revisions, reviewers):
+    """Return a `differential.revision.search` response of the revisions."""
+    data = []
+    for i in range(revisions):
+        revision = {
+            "id": 100000 + i,
+            "type": "DREV",
+            "phid": "PHID-DREV-%020d" % i,
+            "fields": {
+                "title": "Bug %s - Change number %s of the stack r?reviewer" % (i, i),
+                "uri": "https://phabricator.services.mozilla.com/D%s" % (100000 + i),
+                "authorPHID": "PHID-USER-%020d" % i,
+                "status": {
+                    "value": "needs-review",
+                    "name": "Needs Review",
+                    "closed": False,
+                    "color.ansi": "magenta",
+                },
+                "repositoryPHID": "PHID-REPO-%020d" % 0,
+                "diffPHID": "PHID-DIFF-%020d" % i,
+                "summary": "A summary of the change.\n" * 5,
+                "testPlan": "",
+                "isDraft": False,
+                "holdAsDraft": False,
+                "dateCreated": 1500000000 + i,
+                "dateModified": 1500000000 + i,
+                "policy": {"view": "public", "edit": "users"},
+                "bugzilla.bug-id": str(i),
+            },
+            "attachments": {},
+        }
+        if reviewers:
+            revision["attachments"]["reviewers"] = {
+                "reviewers": [
+                    {
+                        "reviewerPHID": "PHID-USER-%020d" % (i + j),
+                        "status": "added",
+                        "isBlocking": False,
+                        "actorPHID": None,
+                    }
+                    for j in range(3)
+                ]
+            }
+        data.append(revision)
+
+    return json.dumps(
+        {
+            "result": {
+                "data": data,
+                "maps": {},
+                "query": {"queryKey": None},
+                "cursor": {"limit": 100, "after": None, "before": None},
+            },
+            "error_code": None,
+            "error_info": None,
+        }
+    )
+
+
+def timed(func, repeat):
+    """Return the best time of `repeat` calls in milliseconds."""
+    best = None
+    for _ in range(repeat):
+        started = time.time()
+        func()
+        elapsed = (time.time() - started) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def gzip_compress(data):
+    """Compress the data like a web server would, level 6 with a gzip header."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("responses", nargs="*", help="Recorded Conduit responses")
+    parser.add_argument("--revisions", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    token = "api-" + "x" * 28
+    requests = [
+        (
+            "revision.search",
+            {
+                "constraints": {"ids": list(range(100000, 100000 + args.revisions))},
+                "attachments": {"reviewers": True},
+            },
+        ),
+        (
+            "revision.edit",
+            {
+                "objectIdentifier": "D100000",
+                "transactions": [
+                    {"type": "title", "value": "Bug 1 - A title r?reviewer"},
+                    {"type": "summary", "value": "A summary of the change.\n" * 5},
+                    {"type": "bugzilla.bug-id", "value": "1"},
+                    {"type": "reviewers.set", "value": ["PHID-USER-%020d" % 0]},
+                ],
+            },
+        ),
+    ]
+    print("%-24s %10s %10s" % ("request", "form", "json"))
+    for name, api_call_args in requests:
+        print(
+            "%-24s %10d %10d"
+            % (
+                name,
+                len(form_post_data(api_call_args, token)),
+                len(mozphab.conduit_post_data(api_call_args, token)),
+            )
+        )
+
+    if args.responses:
+        responses = []
+        for path in args.responses:
+            with open(path) as f:
+                responses.append((os.path.basename(path), f.read()))
+    else:
+        responses = [
+            ("search %s" % args.revisions, search_response(args.revisions, False)),
+            (
+                "search %s +reviewers" % args.revisions,
+                search_response(args.revisions, True),
+            ),
+        ]
+
+    print(
+        "\n%-24s %10s %10s %12s %12s"
+        % ("response", "bytes", "gzip", "decode ms", "gz decode ms")
+    )
+    for name, body in responses:
+        compressed = gzip_compress(body)
+        print(
+            "%-24s %10d %10d %12.2f %12.2f"
+            % (
+                name,
+                len(body),
+                len(compressed),
+                timed(lambda: json.loads(body), args.repeat),
+                timed(
+                    lambda: json.loads(
+                        zlib.decompress(compressed, 16 + zlib.MAX_WBITS)
+                    ),
+                    args.repeat,
+                ),
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
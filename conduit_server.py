@@ -0,0 +1,650 @@
+"""
+A local stand-in for the Phabricator Conduit API and the Bugzilla REST API.
+
+The Conduit methods moz-phab calls are answered from data held in memory, so its
+exchanges with Phabricator can be tested offline and measured reproducibly.  Each
+call can be delayed to simulate a distant server, searches return pages of a
+configurable size, and the calls are counted per method.
+
+Run it to point a repository's `.arcconfig`, or the test plan's CONDUIT_API_URL and
+BUGZILLA_HOST, at it:
+
+    python2 conduit_server.py --port 8080 --latency 0.1 --page-size 20 \\
+        --users reviewer --revisions 3
+
+Or start it from a test:
+
+    server = ConduitServer(latency=0.05)
+    server.start()
+    ...
+    server.stop()
+    assert server.calls["differential.revision.search"] == 1
+
+Requests are accepted with the arguments in a JSON "params" field, as moz-phab
+sends them, or as `name[key][index]=value` form fields, as arc and curl do.
+Responses are gzip compressed when the client accepts it.
+"""
+
+import argparse
+import collections
+import gzip
+import io
+import json
+import re
+import socket
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qsl, urlsplit
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qsl, urlsplit
+
+BUGZILLA_BUG_RE = re.compile(r"^/rest/bug(?:/(\d+))?/?$")
+FORM_KEY_RE = re.compile(r"\[([^\]]*)\]")
+
+
+class ConduitError(Exception):
+    def __init__(self, code, info):
+        super(ConduitError, self).__init__(info)
+        self.code = code
+        self.info = info
+
+
+def form_to_args(pairs):
+    """Return the arguments encoded as `name[key][index]=value` form fields."""
+    args = {}
+    for key, value in pairs:
+        path = [key.split("[", 1)[0]] + FORM_KEY_RE.findall(key)
+        container = args
+        for name, next_name in zip(path, path[1:]):
+            if isinstance(container, list):
+                container.append({} if next_name else [])
+                container = container[-1]
+            else:
+                container = container.setdefault(name, [] if next_name == "" else {})
+        if isinstance(container, list):
+            container.append(value)
+        else:
+            container[path[-1]] = value
+
+    def lists(value):
+        # `ids[0]=1&ids[1]=2` is a list too.
+        if isinstance(value, dict):
+            value = dict((k, lists(v)) for k, v in value.items())
+            if value and all(k.isdigit() for k in value):
+                return [value[k] for k in sorted(value, key=int)]
+        elif isinstance(value, list):
+            return [lists(v) for v in value]
+        return value
+
+    return lists(args)
+
+
+def raw_diff_from_changes(changes):
+    """Return a git diff of the changes sent to `differential.creatediff`."""
+    lines = []
+    for change in changes:
+        old = change.get("oldPath") or change["currentPath"]
+        new = change["currentPath"]
+        lines.append("diff --git a/%s b/%s\n" % (old, new))
+        lines.append(
+            "--- %s\n" % ("a/%s" % old if change.get("oldPath") else "/dev/null")
+        )
+        lines.append("+++ b/%s\n" % new)
+        for hunk in change["hunks"]:
+            lines.append(
+                "@@ -%s,%s +%s,%s @@\n"
+                % (
+                    hunk["oldOffset"],
+                    hunk["oldLength"],
+                    hunk["newOffset"],
+                    hunk["newLength"],
+                )
+            )
+            lines.append(hunk["corpus"])
+    return "".join(lines)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Keep the connections open, as Phabricator does.
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if not isinstance(data, str):
+            data = data.decode("utf-8")
+        path = urlsplit(self.path).path
+        standin = self.server.standin
+        if path.startswith("/api/"):
+            self._send(200, standin.call(path[len("/api/") :], data))
+        elif BUGZILLA_BUG_RE.match(path) and not BUGZILLA_BUG_RE.match(path).group(1):
+            self._send(200, standin.create_bug(json.loads(data or "{}")))
+        else:
+            self._send(404, {"error": True, "message": "Not found"})
+
+    def do_GET(self):
+        m = BUGZILLA_BUG_RE.match(urlsplit(self.path).path)
+        bug = self.server.standin.get_bug(int(m.group(1))) if m and m.group(1) else None
+        if bug:
+            self._send(200, {"bugs": [bug]})
+        else:
+            self._send(404, {"error": True, "code": 101, "message": "Bug not found"})
+
+    def _send(self, status, response):
+        body = json.dumps(response).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        if "gzip" in (self.headers.get("Accept-Encoding") or ""):
+            compressed = io.BytesIO()
+            with gzip.GzipFile(fileobj=compressed, mode="wb") as f:
+                f.write(body)
+            body = compressed.getvalue()
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ConduitServer(object):
+    """Serves the Conduit API under /api/ and Bugzilla's bug creation under /rest/.
+
+    Args:
+        host, port: The address to listen on, any free port by default
+        latency: Seconds every call is delayed by, or a dict of the delays of the
+            API methods, "bugzilla" for the Bugzilla calls
+        page_size: The maximum number of results in a page of search results
+        api_token: The only API token accepted, any token if None
+
+    The calls made are counted by method in `calls`, and their arguments recorded in
+    `requests`.
+    """
+
+    def __init__(
+        self, host="127.0.0.1", port=0, latency=0, page_size=100, api_token=None
+    ):
+        self.latency = latency
+        self.page_size = page_size
+        self.api_token = api_token
+        self.calls = collections.Counter()
+        self.requests = []
+        self.users = collections.OrderedDict()
+        self.projects = collections.OrderedDict()
+        self.repositories = collections.OrderedDict()
+        self.revisions = collections.OrderedDict()
+        self.diffs = collections.OrderedDict()
+        self.edges = []
+        self.bugs = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._ids = collections.Counter()
+        self._server = _ThreadingHTTPServer((host, port), _Handler)
+        self._server.standin = self
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://%s:%s/" % self._server.server_address[:2]
+
+    @property
+    def api_url(self):
+        return self.url + "api/"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _next_id(self, kind):
+        self._ids[kind] += 1
+        return self._ids[kind]
+
+    def _delay(self, name):
+        latency = self.latency
+        if isinstance(latency, dict):
+            latency = latency.get(name, 0)
+        if latency:
+            time.sleep(latency)
+
+    def _record(self, name, args):
+        with self._lock:
+            self.calls[name] += 1
+            self.requests.append((name, args))
+
+    #
+    # Data
+    #
+
+    def add_user(self, name, away_until=None):
+        """Add a Phabricator user, away until the timestamp if given."""
+        phid = "PHID-USER-%s" % name
+        self.users[name] = {
+            "phid": phid,
+            "userName": name,
+            "realName": name.capitalize(),
+            "roles": ["verified", "approved", "activated"],
+            "currentStatus": "away" if away_until else "available",
+            "currentStatusUntil": away_until,
+        }
+        return phid
+
+    def add_project(self, slug):
+        phid = "PHID-PROJ-%s" % slug
+        self.projects[slug] = {
+            "id": len(self.projects) + 1,
+            "type": "PROJ",
+            "phid": phid,
+            "fields": {"name": slug, "slug": slug},
+        }
+        return phid
+
+    def add_repository(self, callsign):
+        phid = "PHID-REPO-%s" % callsign
+        self.repositories[callsign] = {
+            "id": len(self.repositories) + 1,
+            "type": "REPO",
+            "phid": phid,
+            "fields": {"callsign": callsign, "vcs": "hg"},
+        }
+        return phid
+
+    def add_revision(
+        self, title, raw_diff="", summary="", bug_id=None, parent=None, reviewers=()
+    ):
+        """Add a revision with a diff, depending on the parent revision if given.
+
+        Returns: the revision, as returned by `differential.revision.search`.
+        """
+        diff = self._add_diff(raw_diff)
+        revision = self._add_revision()
+        revision["fields"].update(title=title, summary=summary, diffPHID=diff["phid"])
+        revision["fields"]["bugzilla.bug-id"] = str(bug_id) if bug_id else ""
+        diff["fields"]["revisionPHID"] = revision["phid"]
+        revision["attachments"]["reviewers"]["reviewers"] = [
+            {"reviewerPHID": phid, "status": "added", "isBlocking": False}
+            for phid in reviewers
+        ]
+        if parent:
+            self.edges.append((revision["phid"], "revision.parent", parent["phid"]))
+            self.edges.append((parent["phid"], "revision.child", revision["phid"]))
+        return revision
+
+    def _add_revision(self):
+        rev_id = self._next_id("revision")
+        revision = {
+            "id": rev_id,
+            "type": "DREV",
+            "phid": "PHID-DREV-%s" % rev_id,
+            "fields": {
+                "title": "",
+                "summary": "",
+                "testPlan": "",
+                "uri": "%sD%s" % (self.url, rev_id),
+                "authorPHID": "PHID-USER-author",
+                "status": {
+                    "value": "needs-review",
+                    "name": "Needs Review",
+                    "closed": False,
+                    "color.ansi": "magenta",
+                },
+                "repositoryPHID": None,
+                "diffPHID": None,
+                "isDraft": False,
+                "holdAsDraft": False,
+                "dateCreated": int(time.time()),
+                "dateModified": int(time.time()),
+                "policy": {"view": "public", "edit": "users"},
+                "bugzilla.bug-id": "",
+            },
+            "attachments": {"reviewers": {"reviewers": []}},
+        }
+        self.revisions[revision["phid"]] = revision
+        return revision
+
+    def _add_diff(self, raw_diff, properties=None):
+        diff_id = self._next_id("diff")
+        diff = {
+            "id": diff_id,
+            "type": "DIFF",
+            "phid": "PHID-DIFF-%s" % diff_id,
+            "fields": {
+                "revisionPHID": None,
+                "authorPHID": "PHID-USER-author",
+                "repositoryPHID": None,
+                "refs": [],
+                "dateCreated": int(time.time()),
+                "dateModified": int(time.time()),
+                "policy": {"view": "public"},
+            },
+            "raw": raw_diff,
+            "properties": properties or {},
+        }
+        self.diffs[diff["phid"]] = diff
+        return diff
+
+    def create_bug(self, bug):
+        """Bugzilla's `POST /rest/bug`."""
+        self._record("bugzilla.bug.create", bug)
+        self._delay("bugzilla")
+        with self._lock:
+            bug = dict(bug, id=self._next_id("bug"))
+            self.bugs[bug["id"]] = bug
+        return {"id": bug["id"]}
+
+    def get_bug(self, bug_id):
+        """Bugzilla's `GET /rest/bug/<id>`."""
+        self._record("bugzilla.bug.get", {"id": bug_id})
+        self._delay("bugzilla")
+        return self.bugs.get(bug_id)
+
+    #
+    # Conduit
+    #
+
+    def call(self, method, data):
+        """Answer the Conduit call with the form encoded data."""
+        try:
+            form = parse_qsl(data, keep_blank_values=True)
+            fields = dict(form)
+            if "params" in fields:
+                args = json.loads(fields["params"])
+                token = args.pop("__conduit__", {}).get("token")
+            else:
+                args = form_to_args((k, v) for k, v in form if k != "api.token")
+                token = fields.get("api.token")
+            if self.api_token and token != self.api_token:
+                raise ConduitError(
+                    "ERR-INVALID-AUTH", "API token %r is not valid." % token
+                )
+
+            self._record(method, args)
+            self._delay(method)
+            handler = getattr(self, "conduit_%s" % method.replace(".", "_"), None)
+            if not handler:
+                raise ConduitError(
+                    "ERR-CONDUIT-CORE", "Conduit method '%s' does not exist." % method
+                )
+            with self._lock:
+                result = handler(args)
+        except ConduitError as e:
+            error = e
+        except (KeyError, ValueError, TypeError) as e:
+            # Malformed or missing arguments, reported like Phabricator does.
+            error = ConduitError("ERR-CONDUIT-CORE", "%s: %s" % (type(e).__name__, e))
+        else:
+            return {"result": result, "error_code": None, "error_info": None}
+        return {"result": None, "error_code": error.code, "error_info": error.info}
+
+    def _page(self, items, args):
+        """Return the page of search results requested by the arguments."""
+        limit = min(int(args.get("limit") or 100), self.page_size)
+        start = int(args.get("after") or 0)
+        end = start + limit
+        return {
+            "data": items[start:end],
+            "maps": {},
+            "query": {"queryKey": None},
+            "cursor": {
+                "limit": limit,
+                "after": str(end) if end < len(items) else None,
+                "before": None,
+                "order": None,
+            },
+        }
+
+    def conduit_conduit_ping(self, args):
+        return socket.gethostname()
+
+    def conduit_user_query(self, args):
+        names = set(n.lower() for n in args.get("usernames", []))
+        return [u for name, u in self.users.items() if name.lower() in names]
+
+    def conduit_project_search(self, args):
+        slugs = set(s.lower().lstrip("#") for s in args["constraints"].get("slugs", []))
+        found = [p for slug, p in self.projects.items() if slug.lower() in slugs]
+        result = self._page(found, args)
+        result["maps"] = {"slugMap": {}}
+        return result
+
+    def conduit_diffusion_repository_search(self, args):
+        callsigns = args["constraints"].get("callsigns", [])
+        return self._page(
+            [r for c, r in self.repositories.items() if c in callsigns], args
+        )
+
+    def conduit_differential_revision_search(self, args):
+        constraints = args.get("constraints", {})
+        ids = set(int(i) for i in constraints.get("ids", []))
+        phids = set(constraints.get("phids", []))
+        attachments = args.get("attachments", {})
+        found = []
+        for revision in self.revisions.values():
+            if ("ids" in constraints and revision["id"] not in ids) or (
+                "phids" in constraints and revision["phid"] not in phids
+            ):
+                continue
+            found.append(
+                dict(
+                    revision,
+                    attachments=dict(
+                        (name, value)
+                        for name, value in revision["attachments"].items()
+                        if attachments.get(name) in (True, "1", "true")
+                    ),
+                )
+            )
+        return self._page(found, args)
+
+    def conduit_differential_diff_search(self, args):
+        constraints = args.get("constraints", {})
+        ids = set(int(i) for i in constraints.get("ids", []))
+        phids = set(constraints.get("phids", []))
+        revisions = set(constraints.get("revisionPHIDs", []))
+        with_commits = args.get("attachments", {}).get("commits") in (True, "1", "true")
+        found = []
+        for diff in self.diffs.values():
+            if (
+                ("ids" in constraints and diff["id"] not in ids)
+                or ("phids" in constraints and diff["phid"] not in phids)
+                or (
+                    "revisionPHIDs" in constraints
+                    and diff["fields"]["revisionPHID"] not in revisions
+                )
+            ):
+                continue
+            result = dict((k, diff[k]) for k in ("id", "type", "phid", "fields"))
+            result["attachments"] = {}
+            if with_commits:
+                result["attachments"]["commits"] = {"commits": self._commits(diff)}
+            found.append(result)
+        return self._page(found, args)
+
+    def _commits(self, diff):
+        """Return the commits attachment made from the `local:commits` property."""
+        commits = []
+        local_commits = diff["properties"].get("local:commits") or {}
+        for node, commit in local_commits.items():
+            commits.append(
+                {
+                    "identifier": node,
+                    "tree": None,
+                    "parents": commit.get("parents", []),
+                    "author": {
+                        "name": commit.get("author"),
+                        "email": commit.get("authorEmail"),
+                        "raw": "%s <%s>"
+                        % (commit.get("author"), commit.get("authorEmail")),
+                        "epoch": commit.get("time"),
+                    },
+                    "message": commit.get("message"),
+                }
+            )
+        if not commits:
+            # Diffs added to the server directly.
+            commits.append(
+                {
+                    "identifier": None,
+                    "author": {
+                        "name": "Author",
+                        "email": "author@example.com",
+                        "raw": "Author <author@example.com>",
+                        "epoch": diff["fields"]["dateCreated"],
+                    },
+                }
+            )
+        return commits
+
+    def conduit_differential_getrawdiff(self, args):
+        for diff in self.diffs.values():
+            if diff["id"] == int(args["diffID"]):
+                return diff["raw"]
+        raise ConduitError("ERR_NOT_FOUND", "Diff not found.")
+
+    def conduit_differential_creatediff(self, args):
+        diff = self._add_diff(raw_diff_from_changes(args.get("changes", [])))
+        diff["fields"]["repositoryPHID"] = args.get("repositoryPHID")
+        return {
+            "diffid": diff["id"],
+            "phid": diff["phid"],
+            "uri": "%sdifferential/diff/%s/" % (self.url, diff["id"]),
+        }
+
+    def conduit_differential_setdiffproperty(self, args):
+        diff = [d for d in self.diffs.values() if d["id"] == int(args["diff_id"])]
+        if not diff:
+            raise ConduitError("ERR_NOT_FOUND", "Diff not found.")
+        diff[0]["properties"][args["name"]] = json.loads(args["data"])
+        return None
+
+    def conduit_differential_revision_edit(self, args):
+        identifier = args.get("objectIdentifier")
+        if identifier:
+            identifier = str(identifier)
+            revision = self.revisions.get(identifier) or next(
+                (
+                    r
+                    for r in self.revisions.values()
+                    if identifier in (str(r["id"]), "D%s" % r["id"])
+                ),
+                None,
+            )
+            if not revision:
+                raise ConduitError(
+                    "ERR-CONDUIT-CORE", "No object exists with ID %r." % identifier
+                )
+        else:
+            revision = self._add_revision()
+
+        fields = revision["fields"]
+        reviewers = revision["attachments"]["reviewers"]
+        for transaction in args.get("transactions", []):
+            kind, value = transaction["type"], transaction.get("value")
+            if kind == "update":
+                fields["diffPHID"] = value
+                self.diffs[value]["fields"]["revisionPHID"] = revision["phid"]
+                fields["repositoryPHID"] = self.diffs[value]["fields"]["repositoryPHID"]
+            elif kind in ("title", "summary", "testPlan", "bugzilla.bug-id"):
+                fields[kind] = value
+            elif kind == "reviewers.set":
+                reviewers["reviewers"] = [
+                    {
+                        "reviewerPHID": re.sub(r"^blocking\((.*)\)$", r"\1", phid),
+                        "status": "added",
+                        "isBlocking": phid.startswith("blocking("),
+                    }
+                    for phid in value
+                ]
+            elif kind == "parents.set":
+                self.edges = [
+                    e
+                    for e in self.edges
+                    if not (
+                        (e[0] == revision["phid"] and e[1] == "revision.parent")
+                        or (e[2] == revision["phid"] and e[1] == "revision.child")
+                    )
+                ]
+                for parent in value:
+                    self.edges.append((revision["phid"], "revision.parent", parent))
+                    self.edges.append((parent, "revision.child", revision["phid"]))
+        fields["dateModified"] = int(time.time())
+
+        return {
+            "object": {"id": revision["id"], "phid": revision["phid"]},
+            "transactions": [
+                {"phid": "PHID-XACT-DREV-%s" % self._next_id("transaction")}
+                for _ in args.get("transactions", [])
+            ],
+        }
+
+    def conduit_edge_search(self, args):
+        sources = args.get("sourcePHIDs", [])
+        types = args.get("types", [])
+        return self._page(
+            [
+                {"sourcePHID": source, "edgeType": kind, "destinationPHID": dest}
+                for source, kind, dest in self.edges
+                if source in sources and kind in types
+            ],
+            args,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument(
+        "--latency", type=float, default=0, help="Seconds every call is delayed by"
+    )
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--token", help="The only API token accepted")
+    parser.add_argument("--users", nargs="*", default=[], help="Users to add")
+    parser.add_argument(
+        "--revisions", type=int, default=0, help="Add a stack of revisions"
+    )
+    args = parser.parse_args()
+
+    server = ConduitServer(
+        args.host, args.port, args.latency, args.page_size, args.token
+    )
+    for user in args.users:
+        server.add_user(user)
+    parent = None
+    for i in range(args.revisions):
+        diff = (
+            "diff --git a/file-{0} b/file-{0}\nnew file mode 100644\n"
+            "--- /dev/null\n+++ b/file-{0}\n@@ -0,0 +1 @@\n+{0}\n"
+        ).format(i)
+        parent = server.add_revision(
+            "Bug 1 - Change %s" % i, diff, bug_id=1, parent=parent
+        )
+
+    print("Conduit API: %s" % server.api_url)
+    print("Bugzilla: %s" % server.url.rstrip("/"))
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("Calls:")
+        for method, count in sorted(server.calls.items()):
+            print("%6s %s" % (count, method))
+
+
+if __name__ == "__main__":
+    main()
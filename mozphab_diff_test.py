@@ -0,0 +1,1433 @@
+"""
+Exchanging diffs with Phabricator: submitting commits with the Conduit API or arc,
+and storing the downloaded diffs.
+
+    python2 -m pytest mozphab_diff_test.py
+"""
+
+import argparse
+import BaseHTTPServer
+import gzip
+import imp
+import io
+import json
+import logging
+import os
+import socket
+import subprocess
+import threading
+import time
+import urllib2
+import urlparse
+
+import pytest
+
+import conduit_server
+
+mozphab = imp.load_source(
+    "mozphab", os.path.join(os.path.dirname(__file__), "moz-phab")
+)
+
+CHANGE = mozphab.DIFF_CHANGE_TYPE
+
+
+def test_parse_modified_file():
+    changes = mozphab.parse_git_diff(
+        "diff --git a/file b/file\n"
+        "index 1111111..2222222 100644\n"
+        "--- a/file\n"
+        "+++ b/file\n"
+        "@@ -1,3 +1,3 @@\n"
+        " one\n"
+        "-two\n"
+        "+2\n"
+        " three\n"
+        "\\ No newline at end of file\n"
+    )
+    assert len(changes) == 1
+    change = changes[0]
+    assert change["type"] == CHANGE["CHANGE"]
+    assert change["oldPath"] == change["currentPath"] == "file"
+    assert change["hunks"] == [
+        {
+            "oldOffset": 1,
+            "oldLength": 3,
+            "newOffset": 1,
+            "newLength": 3,
+            "addLines": 1,
+            "delLines": 1,
+            "isMissingOldNewline": 1,
+            "isMissingNewNewline": 1,
+            "corpus": " one\n-two\n+2\n three\n",
+        }
+    ]
+
+
+def test_parse_added_and_deleted_files():
+    changes = mozphab.parse_git_diff(
+        "diff --git a/new b/new\n"
+        "new file mode 100755\n"
+        "--- /dev/null\n"
+        "+++ b/new\n"
+        "@@ -0,0 +1 @@\n"
+        "+new\n"
+        "diff --git a/old b/old\n"
+        "deleted file mode 100644\n"
+        "--- a/old\n"
+        "+++ /dev/null\n"
+        "@@ -1 +0,0 @@\n"
+        "-old\n"
+        "diff --git a/empty b/empty\n"
+        "new file mode 100644\n"
+    )
+    added, deleted, empty = changes
+    assert added["type"] == CHANGE["ADD"]
+    assert added["currentPath"] == "new"
+    assert "oldPath" not in added
+    assert added["newProperties"] == {"unix:filemode": "100755"}
+    assert added["hunks"][0]["newLength"] == 1
+    assert deleted["type"] == CHANGE["DELETE"]
+    assert deleted["currentPath"] == deleted["oldPath"] == "old"
+    assert empty["type"] == CHANGE["ADD"]
+    assert empty["currentPath"] == "empty"
+    assert empty["hunks"] == []
+
+
+def test_parse_renames_and_copies():
+    changes = mozphab.parse_git_diff(
+        "diff --git a/f b/g\n"
+        "rename from f\n"
+        "rename to g\n"
+        "diff --git a/h b/i\n"
+        "copy from h\n"
+        "copy to i\n"
+        "--- a/h\n"
+        "+++ b/i\n"
+        "@@ -1 +1 @@\n"
+        "-h\n"
+        "+i\n"
+    )
+    paths = [(c["type"], c.get("oldPath"), c["currentPath"]) for c in changes]
+    assert paths == [
+        (CHANGE["MOVE_AWAY"], "f", "f"),
+        (CHANGE["MOVE_HERE"], "f", "g"),
+        (CHANGE["COPY_AWAY"], "h", "h"),
+        (CHANGE["COPY_HERE"], "h", "i"),
+    ]
+    assert changes[0]["awayPaths"] == ["g"]
+    assert changes[2]["awayPaths"] == ["i"]
+
+
+def test_parse_paths_with_spaces_and_quotes():
+    changes = mozphab.parse_git_diff(
+        "diff --git a/sp ace b/sp ace\n"
+        "new file mode 100644\n"
+        "--- /dev/null\n"
+        "+++ b/sp ace\t\n"
+        "@@ -0,0 +1,1 @@\n"
+        "+x\n"
+        'diff --git "a/tab\\there" "b/tab\\there"\n'
+        "old mode 100644\n"
+        "new mode 100755\n"
+    )
+    assert changes[0]["currentPath"] == "sp ace"
+    assert changes[1]["currentPath"] == "tab\there"
+    assert changes[1]["oldProperties"] == {"unix:filemode": "100644"}
+    assert changes[1]["newProperties"] == {"unix:filemode": "100755"}
+
+
+@pytest.mark.parametrize(
+    "diff",
+    [
+        "diff --git a/bin b/bin\nindex 1..2 100644\nBinary files differ\n",
+        "diff --git a/bin b/bin\nnew file mode 100644\nGIT binary patch\nliteral 2\n",
+        "diff --git a/sub b/sub\nnew file mode 160000\nindex 0..1\n",
+    ],
+)
+def test_parse_unsupported(diff):
+    with pytest.raises(mozphab.UnsupportedDiffError):
+        mozphab.parse_git_diff(diff)
+
+
+@pytest.mark.skipif(not mozphab.which("git"), reason="Git is not installed")
+def test_git_commit_diff(tmpdir, monkeypatch):
+    monkeypatch.setattr(mozphab, "config", mozphab.Config(should_access_file=False))
+
+    def git(*args):
+        return subprocess.check_output(["git"] + list(args), cwd=str(tmpdir))
+
+    git("init", "-q")
+    git("config", "user.name", "Author")
+    git("config", "user.email", "author@example.com")
+    tmpdir.join(".arcconfig").write('{"phabricator.uri": "https://phab.test/"}')
+    tmpdir.join("file").write("".join("line %s\n" % i for i in range(10)))
+    git("add", ".")
+    git("commit", "-q", "-m", "base")
+    tmpdir.join("file").write("".join("line %s\n" % i for i in range(1, 11)))
+    git("commit", "-q", "-a", "-m", "change")
+
+    repo = mozphab.Git(str(tmpdir))
+    patch = repo.commit_diff(git("rev-parse", "HEAD").strip(), 32767)
+    assert patch["parent"] == git("rev-parse", "HEAD^").strip()
+    assert patch["author-name"] == "Author"
+    assert patch["author-email"] == "author@example.com"
+
+    (change,) = mozphab.parse_git_diff(patch["diff"])
+    assert change["currentPath"] == "file"
+    (hunk,) = change["hunks"]
+    assert (hunk["oldLength"], hunk["newLength"]) == (10, 10)
+    assert (hunk["addLines"], hunk["delLines"]) == (1, 1)
+
+
+class FakeConduit(object):
+    """Records the Conduit calls made by the submission."""
+
+    def __init__(self, revisions=()):
+        self.calls = []
+        self.revisions = list(revisions)
+
+    def __call__(self, method, args):
+        self.calls.append((method, args))
+        if method == "differential.creatediff":
+            return {"diffid": 12, "phid": "PHID-DIFF-1"}
+        if method == "differential.revision.edit":
+            return {"object": {"id": 34, "phid": "PHID-DREV-1"}}
+        if method == "diffusion.repository.search":
+            return {"data": [{"phid": "PHID-REPO-1"}]}
+        if method == "differential.revision.search":
+            return {"data": self.revisions}
+        return None
+
+
+def test_conduit_submit_commit(tmpdir, monkeypatch):
+    monkeypatch.setattr(mozphab, "cache", mozphab.SimpleCache())
+    tmpdir.join(".arcconfig").write(
+        '{"phabricator.uri": "https://phab.test/", "repository.callsign": "TEST"}'
+    )
+    repo = mozphab.Repository(str(tmpdir), str(tmpdir))
+    repo.vcs = "git"
+    repo.call_conduit = FakeConduit()
+    repo.commit_diff = lambda node, context: {
+        "parent": "p" * 40,
+        "author-name": "Author",
+        "author-email": "author@example.com",
+        "author-time": 1500000000,
+        "diff": "diff --git a/f b/f\n--- a/f\n+++ b/f\n@@ -1 +1 @@\n-a\n+b\n",
+    }
+    commit = {
+        "node": "n" * 40,
+        "title-preview": "Bug 1 - Title r=reviewer",
+        "body": "Body",
+        "bug-id": "1",
+        "reviewers": dict(request=[], granted=[]),
+    }
+    args = argparse.Namespace(lesscontext=False, wip=False, message=None)
+
+    url, diff_phid = mozphab.conduit_submit_commit(
+        repo, commit, args, depends_on="Depends on D33"
+    )
+
+    assert url == "https://phab.test/D34"
+    assert diff_phid == "PHID-DIFF-1"
+    methods = [method for method, _ in repo.call_conduit.calls]
+    assert methods == [
+        "diffusion.repository.search",
+        "differential.creatediff",
+        "differential.setdiffproperty",
+        "differential.revision.edit",
+    ]
+    creatediff = repo.call_conduit.calls[1][1]
+    assert creatediff["repositoryPHID"] == "PHID-REPO-1"
+    assert creatediff["sourceControlBaseRevision"] == "p" * 40
+    local_commits = json.loads(repo.call_conduit.calls[2][1]["data"])
+    assert local_commits["n" * 40]["authorEmail"] == "author@example.com"
+    transactions = repo.call_conduit.calls[3][1]["transactions"]
+    assert transactions == [
+        {"type": "update", "value": "PHID-DIFF-1"},
+        {"type": "title", "value": "Bug 1 - Title r=reviewer"},
+        {"type": "summary", "value": "Body\n\nDepends on D33"},
+        {"type": "bugzilla.bug-id", "value": "1"},
+    ]
+
+
+def test_conduit_update_revision_in_one_edit(tmpdir, monkeypatch):
+    monkeypatch.setattr(mozphab, "cache", mozphab.SimpleCache())
+    tmpdir.join(".arcconfig").write('{"phabricator.uri": "https://phab.test/"}')
+    repo = mozphab.Repository(str(tmpdir), str(tmpdir))
+    mozphab.cache.set(
+        mozphab.phab_cache_key(repo, "user-reviewer"), {"phid": "PHID-USER-1"}
+    )
+    repo.vcs = "git"
+    repo.call_conduit = FakeConduit()
+    repo.commit_diff = lambda node, context: {
+        "parent": "p" * 40,
+        "author-name": "Author",
+        "author-email": "author@example.com",
+        "author-time": 1500000000,
+        "diff": "diff --git a/f b/f\n--- a/f\n+++ b/f\n@@ -1 +1 @@\n-a\n+b\n",
+    }
+    commit = {
+        "node": "n" * 40,
+        "rev-id": "34",
+        "title": "Bug 2 - Title",
+        "title-preview": "Bug 2 - Title r=reviewer",
+        "body": "Body\n\nDifferential Revision: https://phab.test/D34",
+        "bug-id": "2",
+        "reviewers": dict(request=["reviewer"], granted=[]),
+    }
+    revision = {
+        "id": 34,
+        "phid": "PHID-DREV-1",
+        "fields": {"bugzilla.bug-id": "1"},
+        "attachments": {"reviewers": {"reviewers": []}},
+    }
+    args = argparse.Namespace(lesscontext=False, wip=False, message=None)
+
+    mozphab.conduit_submit_commit(repo, commit, args, revision=revision)
+
+    methods = [method for method, _ in repo.call_conduit.calls]
+    assert methods.count("differential.revision.edit") == 1
+    edit = repo.call_conduit.calls[-1][1]
+    assert edit["objectIdentifier"] == "PHID-DREV-1"
+    assert edit["transactions"] == [
+        {"type": "update", "value": "PHID-DIFF-1"},
+        {"type": "comment", "value": mozphab.DEFAULT_UPDATE_MESSAGE},
+        {"type": "title", "value": "Bug 2 - Title"},
+        {"type": "summary", "value": "Body"},
+        {"type": "bugzilla.bug-id", "value": "2"},
+        {"type": "reviewers.set", "value": ["PHID-USER-1"]},
+    ]
+
+
+class PreflightRepo(object):
+    """Repository whose status can only be read while Conduit is being checked."""
+
+    def __init__(self, arc_error=None):
+        self.arc_error = arc_error
+        self.checking_conduit = threading.Event()
+        self.status_read = threading.Event()
+
+    def check_arc(self):
+        if self.arc_error:
+            raise self.arc_error
+        return True
+
+    def check_conduit(self):
+        self.checking_conduit.set()
+        assert self.status_read.wait(5)
+        return True
+
+    def prefetch_status(self):
+        assert self.checking_conduit.wait(5)
+        self.status_read.set()
+
+
+def test_submit_preflight_overlaps_checks():
+    args = argparse.Namespace(no_arc=False, wip=True)
+    commits = [{"rev-id": None, "reviewers": dict(request=[], granted=[])}]
+
+    repo = PreflightRepo()
+    assert mozphab.submit_preflight(repo, commits, args) == dict(arc=True, conduit=True)
+    assert repo.status_read.is_set()
+
+    repo = PreflightRepo(arc_error=mozphab.CommandError("arc failed"))
+    with pytest.raises(mozphab.CommandError):
+        mozphab.submit_preflight(repo, commits, args)
+
+
+def test_submit_journal(tmpdir, monkeypatch):
+    monkeypatch.setattr(mozphab, "cache", mozphab.SimpleCache())
+    tmpdir.join(".arcconfig").write('{"phabricator.uri": "https://phab.test/"}')
+    repo = mozphab.Repository(str(tmpdir), str(tmpdir))
+    repo.call_conduit = FakeConduit(
+        [
+            {
+                "id": i,
+                "phid": "PHID-DREV-%s" % i,
+                "fields": {"status": {"closed": closed}},
+                "attachments": {"reviewers": {}},
+            }
+            for i, closed in ((1, False), (2, True))
+        ]
+    )
+    repo.commit_diff = lambda node, context: {"diff": "diff of %s" % node[0]}
+    args = argparse.Namespace(
+        lesscontext=False, upload_all=False, no_arc=True, yes=False
+    )
+    answers = []
+    monkeypatch.setattr(mozphab, "prompt", lambda question, options: answers.pop())
+
+    def commit(node, rev_id=None):
+        return {"node": node, "name": node, "rev-id": rev_id}
+
+    # The key only depends on the change.
+    key = mozphab.submit_journal_key(repo, commit("a1"), args)
+    assert key == mozphab.submit_journal_key(repo, commit("a2"), args)
+    assert key != mozphab.submit_journal_key(repo, commit("b1"), args)
+
+    mozphab.cache.set(key, {"rev-id": "1", "diff": "PHID-DIFF-1", "node": "a1"})
+    mozphab.cache.set(
+        mozphab.submit_journal_key(repo, commit("b1"), args),
+        {"rev-id": "2", "diff": None, "node": "b1"},
+    )
+    # The closed revision isn't reused, nor the one uploaded from another commit.
+    commits = [commit("a1"), commit("b1"), commit("c1", "3")]
+    answers.append("Yes")
+    mozphab.resume_submit(repo, commits, args)
+    assert [c["rev-id"] for c in commits] == ["1", None, "3"]
+    commits = [commit("a2")]
+    mozphab.resume_submit(repo, commits, args)
+    assert commits[0]["rev-id"] is None
+
+    # The user declines.
+    commits = [commit("a1")]
+    answers.append("No")
+    mozphab.resume_submit(repo, commits, args)
+    assert commits[0]["rev-id"] is None
+    assert answers == []
+
+    args.upload_all = True
+    mozphab.resume_submit(repo, commits, args)
+    assert commits[0]["rev-id"] is None
+
+    # Submitting with arc hashes the diff without context lines.
+    args.no_arc = False
+    args.upload_all = False
+    contexts = []
+
+    def commit_diff(node, context):
+        contexts.append(context)
+        return {"diff": "diff of %s without context" % node[0]}
+
+    repo.commit_diff = commit_diff
+    key = mozphab.submit_journal_key(repo, commit("d1"), args)
+    assert contexts == [0]
+    mozphab.cache.set(key, {"rev-id": "1", "diff": None, "node": "d1"})
+    commits = [commit("d1")]
+    answers.append("Yes")
+    mozphab.resume_submit(repo, commits, args)
+    assert commits[0]["rev-id"] == "1"
+
+
+def test_update_revision_parent(tmpdir, monkeypatch):
+    monkeypatch.setattr(mozphab, "cache", mozphab.SimpleCache())
+    tmpdir.join(".arcconfig").write('{"phabricator.uri": "https://phab.test/"}')
+    repo = mozphab.Repository(str(tmpdir), str(tmpdir))
+    repo.call_conduit = FakeConduit(
+        [{"id": 2, "phid": "PHID-DREV-2", "fields": {}, "attachments": {}}]
+    )
+    commit = {
+        "rev-id": "3",
+        "title": "Bug 1 - Title",
+        "body": "Body\n\nDepends on D1\n\nDifferential Revision: https://phab.test/D3",
+        "bug-id": "1",
+        "reviewers": dict(request=[], granted=[]),
+    }
+    revision = {
+        "fields": {
+            "title": "Bug 1 - Title",
+            "summary": "Body\n\nDepends on D1",
+            "bugzilla.bug-id": "1",
+            "status": {"value": "needs-review"},
+        },
+        "attachments": {"reviewers": {"reviewers": []}},
+    }
+    args = argparse.Namespace(wip=False, message=None)
+
+    # The diff wasn't uploaded again, the revision moved in the stack.
+    mozphab.update_revision(
+        repo, commit, revision, args, uploaded=False, depends_on="Depends on D2"
+    )
+
+    method, api_call_args = repo.call_conduit.calls[-1]
+    assert method == "differential.revision.edit"
+    assert api_call_args["transactions"] == [
+        {"type": "summary", "value": "Body"},
+        {"type": "parents.set", "value": ["PHID-DREV-2"]},
+    ]
+
+
+FAKE_ARC = """#!/bin/sh
+echo "$(pwd) $(git rev-parse HEAD)"
+echo "Revision URI: https://phab.test/D$(git log -1 --format=%s | cut -d' ' -f2)"
+"""
+
+
+@pytest.mark.skipif(not mozphab.which("git"), reason="Git is not installed")
+def test_upload_commits_in_worktrees(tmpdir, monkeypatch):
+    monkeypatch.setattr(mozphab, "config", mozphab.Config(should_access_file=False))
+    monkeypatch.setattr(mozphab, "cache", mozphab.SimpleCache())
+    arc = tmpdir.join("arc")
+    arc.write(FAKE_ARC)
+    arc.chmod(0o755)
+    monkeypatch.setattr(mozphab, "ARC", [str(arc)])
+
+    path = tmpdir.mkdir("repo")
+
+    def git(*args):
+        return subprocess.check_output(["git"] + list(args), cwd=str(path)).strip()
+
+    git("init", "-q")
+    git("config", "user.name", "Author")
+    git("config", "user.email", "author@example.com")
+    path.join(".arcconfig").write('{"phabricator.uri": "https://phab.test/"}')
+    git("add", ".")
+    git("commit", "-q", "-m", "base")
+    for i in range(1, 5):
+        path.join("file-%s" % i).write("%s\n" % i)
+        git("add", ".")
+        git("commit", "-q", "-m", "change %s" % i)
+
+    branch = git("symbolic-ref", "HEAD")
+    repo = mozphab.Git(str(path))
+    commits = [
+        {
+            "node": git("rev-parse", "HEAD~%s" % i),
+            "rev-id": None,
+            "title-preview": "change",
+            "body": "",
+            "reviewers": dict(request=[], granted=[]),
+            "bug-id": "1",
+        }
+        for i in reversed(range(4))
+    ]
+    args = argparse.Namespace(
+        lesscontext=False,
+        upload_all=False,
+        no_arc=False,
+        nolint=True,
+        wip=False,
+        message=None,
+    )
+    worktrees = mozphab.Queue.Queue()
+
+    def upload(commit):
+        output = []
+        result = mozphab.upload_commit(
+            repo, commit, args, worktrees=worktrees, output=output
+        )
+        return result, output
+
+    results = list(mozphab.parallel_map(upload, commits, max_workers=2))
+
+    assert [url for (url, _, _), _ in results] == [
+        "https://phab.test/D%s" % i for i in range(1, 5)
+    ]
+    for commit, (_, output) in zip(commits, results):
+        cwd, head = output[0].split()
+        assert head == commit["node"]
+        assert os.path.realpath(cwd) != os.path.realpath(str(path))
+    # The repository's working directory isn't touched.
+    assert git("symbolic-ref", "HEAD") == branch
+
+    assert 1 <= worktrees.qsize() <= 2
+    while not worktrees.empty():
+        worktree = worktrees.get()
+        repo.remove_worktree(worktree)
+        assert not os.path.exists(worktree)
+    assert len(git("worktree", "list").splitlines()) == 1
+
+
+def test_parallel_map_waits_for_calls_in_progress():
+    finished = []
+
+    def call(item):
+        if item == "fail":
+            raise ValueError(item)
+        time.sleep(0.3)
+        finished.append(item)
+
+    # The failure is raised once the call in progress ended, no new calls start.
+    with pytest.raises(ValueError):
+        list(mozphab.parallel_map(call, ["slow", "fail", "never"], max_workers=2))
+    assert finished == ["slow"]
+
+
+def test_parallel_map_keeps_order():
+    finished = []
+
+    def call(item):
+        time.sleep(0.1 * (3 - item))
+        finished.append(item)
+        return item * 10
+
+    results = list(mozphab.parallel_map(call, range(4), max_workers=4))
+    assert results == [0, 10, 20, 30]
+    assert finished == [3, 2, 1, 0]
+
+
+def test_parallel_map_stops_at_failure():
+    called = []
+
+    def call(item):
+        called.append(item)
+        if item == 2:
+            raise ValueError(item)
+        return item
+
+    # The results before the failure are yielded, the later items aren't called.
+    results = mozphab.parallel_map(call, range(5), max_workers=1)
+    assert next(results) == 0
+    assert next(results) == 1
+    with pytest.raises(ValueError) as e:
+        next(results)
+    assert e.value.args == (2,)
+    assert called == [0, 1, 2]
+    with pytest.raises(StopIteration):
+        next(results)
+
+
+def test_diff_store(tmpdir):
+    store = mozphab.DiffStore(str(tmpdir), max_size=1000)
+    assert store.get("raw-1") is None
+
+    store.set("raw-1", b"diff 1")
+    store.set("raw-2", b"diff 1")
+    assert store.get("raw-1") == store.get("raw-2") == b"diff 1"
+    # The contents are stored once.
+    objects = tmpdir.join("objects")
+    assert len(objects.listdir()) == 1
+
+    # Corrupted contents are ignored.
+    (obj,) = objects.listdir()[0].listdir()
+    obj.write(mozphab.zlib.compress(b"something else"), mode="wb")
+    assert store.get("raw-1") is None
+
+
+def test_diff_store_prune(tmpdir):
+    # Contents compressing badly, about 500 bytes each.
+    contents = [os.urandom(500) for _ in range(3)]
+    store = mozphab.DiffStore(str(tmpdir), max_size=1200)
+    for i, data in enumerate(contents):
+        store.set("phab.test/raw-%s" % i, data)
+    for i, data in enumerate(contents):
+        digest = mozphab.hashlib.sha1(data).hexdigest()
+        tmpdir.join("objects", digest[:2], digest[2:]).setmtime(1000000000 + i)
+    # raw-0 is read, raw-1 is now the least recently used.
+    store.get("phab.test/raw-0")
+
+    store.prune()
+
+    assert store.get("phab.test/raw-0") == contents[0]
+    assert store.get("phab.test/raw-2") == contents[2]
+    assert store.get("phab.test/raw-1") is None
+    assert not tmpdir.join("refs", "phab.test", "raw-1").exists()
+
+
+STACK_DIFFS = [
+    "diff --git a/file b/file\n"
+    "--- a/file\n"
+    "+++ b/file\n"
+    "@@ -1 +1 @@\n"
+    "-base\r\n"
+    "+first\r\n",
+    "diff --git a/new b/new\n"
+    "new file mode 100644\n"
+    "--- /dev/null\n"
+    "+++ b/new\n"
+    "@@ -0,0 +1 @@\n"
+    "+second\n",
+]
+STACK_AUTHOR = b"Ann\xc3\xa9e".decode("utf8")
+STACK_BODIES = [
+    "Bug 1 - [tag] First\n\nFrom the summary\n>From quoted\n\nDifferential Revision: x",
+    "Bug 1 - Second by %s\n\nDifferential Revision: y" % STACK_AUTHOR,
+]
+
+
+@pytest.mark.skipif(not mozphab.which("git"), reason="Git is not installed")
+def test_git_apply_patches(tmpdir, monkeypatch):
+    monkeypatch.setattr(mozphab, "config", mozphab.Config(should_access_file=False))
+
+    def git(*args):
+        return subprocess.check_output(["git"] + list(args), cwd=str(tmpdir))
+
+    git("init", "-q")
+    git("config", "user.name", "Committer")
+    git("config", "user.email", "committer@example.com")
+    tmpdir.join(".arcconfig").write('{"phabricator.uri": "https://phab.test/"}')
+    tmpdir.join("file").write("base\r\n", mode="wb")
+    git("add", ".")
+    git("commit", "-q", "-m", "base")
+
+    repo = mozphab.Git(str(tmpdir))
+    repo.apply_patches(
+        {
+            "diff": diff,
+            "body": body,
+            "author": "%s <author@example.com>" % STACK_AUTHOR,
+            "author-date": 1500000000 + i,
+        }
+        for i, (diff, body) in enumerate(zip(STACK_DIFFS, STACK_BODIES))
+    )
+
+    log = git("log", "-2", "--reverse", "--format=%an%x00%ae%x00%at%x00%B%x01")
+    commits = [c.strip("\n").split("\0") for c in log.split("\1")[:-1]]
+    assert [c[:3] for c in commits] == [
+        [STACK_AUTHOR.encode("utf8"), "author@example.com", str(1500000000 + i)]
+        for i in range(2)
+    ]
+    assert [c[3].decode("utf8").rstrip("\n") for c in commits] == STACK_BODIES
+    assert tmpdir.join("file").read(mode="rb") == "first\r\n"
+    assert git("status", "--porcelain") == ""
+
+    # A failing patch leaves the repository unchanged.
+    head = git("rev-parse", "HEAD")
+    with pytest.raises(subprocess.CalledProcessError):
+        repo.apply_patches(
+            {"diff": diff, "body": body, "author": "A <a@a>", "author-date": 0}
+            for diff, body in zip(STACK_DIFFS[::-1], STACK_BODIES)
+        )
+    assert git("rev-parse", "HEAD") == head
+
+
+def test_patch_break_bodies():
+    # Messages `git am` and `hg import` would cut short or read headers from.
+    for body in (
+        "Title\n\ndiff -r 1 -r 2",
+        "Title\n\n---\nmore",
+        "Title\n\nIndex: file",
+        "Title\nSubject: other",
+    ):
+        assert mozphab.PATCH_BREAK_RE.search(body)
+    assert not mozphab.PATCH_BREAK_RE.search("Title\n\nFrom the summary\n---a")
+
+
+class FakePhabricator(FakeConduit):
+    """Serves the revisions, stack edges and diffs needed to patch."""
+
+    def __init__(self, revisions, parents, raw_diffs):
+        super(FakePhabricator, self).__init__()
+        self.by_phid = dict((r["phid"], r) for r in revisions)
+        self.parents = parents
+        self.raw_diffs = raw_diffs
+
+    def __call__(self, method, args):
+        self.calls.append((method, args))
+        if method == "differential.revision.search":
+            constraints = args["constraints"]
+            return {
+                "data": [
+                    r
+                    for r in self.by_phid.values()
+                    if r["id"] in constraints.get("ids", [])
+                    or r["phid"] in constraints.get("phids", [])
+                ]
+            }
+        if method == "edge.search":
+            data = []
+            for phid in args["sourcePHIDs"]:
+                for parent in self.parents.get(phid, []):
+                    data.append(
+                        dict(
+                            sourcePHID=phid,
+                            edgeType="revision.parent",
+                            destinationPHID=parent,
+                        )
+                    )
+                for child, parents in self.parents.items():
+                    if phid in parents:
+                        data.append(
+                            dict(
+                                sourcePHID=phid,
+                                edgeType="revision.child",
+                                destinationPHID=child,
+                            )
+                        )
+            return {"data": data}
+        if method == "differential.diff.search":
+            author = {"name": "Author", "email": "author@example.com"}
+            return {
+                "data": [
+                    {
+                        "id": int(phid.rsplit("-", 1)[1]),
+                        "phid": phid,
+                        "fields": {"dateCreated": 1500000000, "refs": []},
+                        "attachments": {"commits": {"commits": [{"author": author}]}},
+                    }
+                    for phid in args["constraints"]["phids"]
+                ]
+            }
+        if method == "differential.getrawdiff":
+            return self.raw_diffs[args["diffID"]]
+
+
+@pytest.mark.skipif(not mozphab.which("git"), reason="Git is not installed")
+def test_patch_revisions(tmpdir, monkeypatch):
+    monkeypatch.setattr(mozphab, "config", mozphab.Config(should_access_file=False))
+    monkeypatch.setattr(mozphab, "cache", mozphab.SimpleCache())
+    monkeypatch.setattr(
+        mozphab, "diff_store", mozphab.DiffStore(str(tmpdir.join("store")), 1 << 20)
+    )
+    path = tmpdir.mkdir("repo")
+
+    def git(*args):
+        return subprocess.check_output(["git"] + list(args), cwd=str(path))
+
+    git("init", "-q")
+    git("config", "user.name", "Committer")
+    git("config", "user.email", "committer@example.com")
+    path.join(".arcconfig").write('{"phabricator.uri": "https://phab.test/"}')
+    path.join("file").write("base\n")
+    git("add", ".")
+    git("commit", "-q", "-m", "base")
+    git("checkout", "-q", "--detach")
+
+    # D2 and D3 both depend on D1.
+    revisions = [
+        {
+            "id": i,
+            "phid": "PHID-DREV-%s" % i,
+            "fields": {
+                "title": "Bug 1 - Change %s" % i,
+                "summary": "",
+                "diffPHID": "PHID-DIFF-%s" % (i * 10),
+            },
+        }
+        for i in (1, 2, 3)
+    ]
+    phabricator = FakePhabricator(
+        revisions,
+        parents={"PHID-DREV-2": ["PHID-DREV-1"], "PHID-DREV-3": ["PHID-DREV-1"]},
+        raw_diffs={
+            10: "diff --git a/file b/file\n--- a/file\n+++ b/file\n"
+            "@@ -1 +1 @@\n-base\n+first\n",
+            20: "diff --git a/two b/two\nnew file mode 100644\n--- /dev/null\n"
+            "+++ b/two\n@@ -0,0 +1 @@\n+two\n",
+            30: "diff --git a/three b/three\nnew file mode 100644\n--- /dev/null\n"
+            "+++ b/three\n@@ -0,0 +1 @@\n+three\n",
+        },
+    )
+    repo = mozphab.Git(str(path))
+    repo.call_conduit = phabricator
+    repo.check_conduit = lambda: True
+    tmpdir.join("revisions").write("D3\nD1\n")
+    repo.args = argparse.Namespace(
+        revisions=["D2", "1"],
+        revisions_file=str(tmpdir.join("revisions")),
+        apply_to="here",
+        raw=False,
+        no_commit=False,
+        no_branch=False,
+        skip_dependencies=False,
+        yes=True,
+    )
+
+    mozphab.patch(repo, repo.args)
+
+    def log(branch):
+        return git("log", "--format=%s", branch).splitlines()
+
+    assert log("D2") == ["Bug 1 - Change 2", "Bug 1 - Change 1", "base"]
+    assert log("D3") == ["Bug 1 - Change 3", "Bug 1 - Change 1", "base"]
+    assert "D1" not in git("branch", "--list")
+    assert git("show", "D3:file") == "first\n"
+
+    methods = [method for method, _ in phabricator.calls]
+    assert methods.count("differential.revision.search") == 1
+    assert methods.count("differential.diff.search") == 1
+    assert methods.count("differential.getrawdiff") == 3
+
+
+def test_prefetch_invalid_revision(tmpdir, monkeypatch):
+    monkeypatch.setattr(mozphab, "config", mozphab.Config(should_access_file=False))
+    repo = argparse.Namespace(check_conduit=lambda: True)
+    tmpdir.join("revisions").write("D3\nDabc\n")
+
+    args = mozphab.parse_args(["prefetch", "D2", "Dxyz"])
+    with pytest.raises(mozphab.Error, match="Invalid revision: Dxyz"):
+        mozphab.prefetch(repo, args)
+
+    args = mozphab.parse_args(
+        ["prefetch", "D2", "--revisions-file", str(tmpdir.join("revisions"))]
+    )
+    with pytest.raises(mozphab.Error, match="Invalid revision: Dabc"):
+        mozphab.prefetch(repo, args)
+
+
+class PagedConduit(object):
+    """Returns search results in pages of `page_size`, with a cursor to the next."""
+
+    def __init__(self, page_size):
+        self.page_size = page_size
+        self.calls = []
+
+    def __call__(self, method, args):
+        self.calls.append(args)
+        values = args.get("sourcePHIDs") or args["constraints"]["ids"]
+        start = int(args.get("after") or 0)
+        end = start + min(self.page_size, args["limit"])
+        return {
+            "data": values[start:end],
+            "cursor": {"after": str(end) if end < len(values) else None},
+        }
+
+
+class FakeEdges(object):
+    """Answers `edge.search` from a list of (parent, child) PHIDs."""
+
+    def __init__(self, pairs):
+        self.pairs = pairs
+        self.calls = []
+
+    def __call__(self, method, args):
+        assert method == "edge.search"
+        self.calls.append(sorted(args["sourcePHIDs"]))
+        for source in args["sourcePHIDs"]:
+            for parent, child in self.pairs:
+                if source == child:
+                    yield dict(
+                        sourcePHID=source,
+                        edgeType="revision.parent",
+                        destinationPHID=parent,
+                    )
+                if source == parent:
+                    yield dict(
+                        sourcePHID=source,
+                        edgeType="revision.child",
+                        destinationPHID=child,
+                    )
+
+
+@pytest.fixture
+def graph_repo(tmpdir, monkeypatch):
+    monkeypatch.setattr(mozphab, "cache", mozphab.SimpleCache())
+    tmpdir.join(".arcconfig").write('{"phabricator.uri": "https://phab.test/"}')
+    return mozphab.Repository(str(tmpdir), str(tmpdir))
+
+
+def test_stack_graph_linear(graph_repo):
+    graph_repo.search_conduit = FakeEdges([("A", "B"), ("B", "C"), ("C", "D")])
+    graph = mozphab.StackGraph(graph_repo)
+
+    # One call per step away from the revision, in both directions at once.
+    graph.resolve(["B"])
+    assert graph_repo.search_conduit.calls == [["B"], ["A", "C"], ["D"]]
+    assert graph.walk("B", "parent") == (["A"], True)
+    assert graph.walk("B", "child") == (["C", "D"], True)
+    assert graph.walk("D", "child") == ([], True)
+
+    # The edges are read from the cache by the next graph.
+    graph = mozphab.StackGraph(graph_repo)
+    graph.resolve(["A"])
+    assert len(graph_repo.search_conduit.calls) == 3
+    assert graph.walk("A", "child") == (["B", "C", "D"], True)
+
+
+def test_stack_graph_fork(graph_repo):
+    graph_repo.search_conduit = FakeEdges([("A", "B"), ("B", "C"), ("B", "E")])
+    graph = mozphab.StackGraph(graph_repo)
+
+    # The search stops at the fork.
+    graph.resolve(["A"])
+    assert graph_repo.search_conduit.calls == [["A"], ["B"]]
+    assert graph.walk("A", "child") == (["B"], False)
+    assert graph.walk("B", "child") == ([], False)
+    assert graph.walk("B", "parent") == (["A"], True)
+
+
+def test_stack_graph_loop(graph_repo):
+    graph_repo.search_conduit = FakeEdges([("A", "B"), ("B", "C"), ("C", "A")])
+    graph = mozphab.StackGraph(graph_repo)
+
+    graph.resolve(["A"])
+    assert len(graph_repo.search_conduit.calls) == 2
+    found, linear = graph.walk("A", "child")
+    assert not linear
+    assert found == ["B", "C", "A"]
+
+
+def test_search_conduit_follows_cursors(tmpdir):
+    tmpdir.join(".arcconfig").write('{"phabricator.uri": "https://phab.test/"}')
+    repo = mozphab.Repository(str(tmpdir), str(tmpdir))
+    repo.call_conduit = PagedConduit(page_size=40)
+
+    ids = list(range(250))
+    results = repo.search_conduit(
+        "differential.revision.search",
+        {"constraints": {"ids": ids, "statuses": ["open"]}},
+    )
+    assert not repo.call_conduit.calls
+    assert list(results) == ids
+    # Three searches of up to 100 IDs, of three, three and two pages.
+    calls = repo.call_conduit.calls
+    assert len(calls) == 8
+    assert [len(c["constraints"]["ids"]) for c in calls] == [100] * 6 + [50] * 2
+    assert [c.get("after") for c in calls[:3]] == [None, "40", "80"]
+    assert all(c["constraints"]["statuses"] == ["open"] for c in calls)
+
+    repo.call_conduit = PagedConduit(page_size=100)
+    phids = ["PHID-%s" % i for i in range(150)]
+    results = repo.search_conduit(
+        "edge.search", {"sourcePHIDs": phids, "types": ["revision.parent"]}
+    )
+    assert list(results) == phids
+    assert [len(c["sourcePHIDs"]) for c in repo.call_conduit.calls] == [100, 50]
+
+
+class ConduitHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers Conduit calls with a gzip compressed response, when accepted."""
+
+    requests = []
+
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers["Content-Length"]))
+        self.requests.append((self.headers["Accept-Encoding"], urlparse.parse_qs(data)))
+        body = json.dumps({"result": {"data": []}, "error_code": None})
+        self.send_response(200)
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            compressed = io.BytesIO()
+            with gzip.GzipFile(fileobj=compressed, mode="wb") as f:
+                f.write(body)
+            body = compressed.getvalue()
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def conduit_repo(tmpdir):
+    """Return a repository calling a local ConduitHandler server."""
+    server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), ConduitHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    tmpdir.join(".arcconfig").write(
+        '{"phabricator.uri": "http://127.0.0.1:%s/"}' % server.server_port
+    )
+    repo = mozphab.Repository(str(tmpdir), str(tmpdir))
+    repo.load_api_token = lambda: "api-token"
+    yield repo
+    server.shutdown()
+
+
+def test_call_conduit(conduit_repo):
+    result = conduit_repo.call_conduit(
+        "differential.revision.search",
+        {"constraints": {"ids": [1, 2]}, "attachments": {"reviewers": True}},
+    )
+
+    assert result == {"data": []}
+    accept_encoding, request = ConduitHandler.requests[-1]
+    assert accept_encoding == "gzip"
+    assert request["output"] == ["json"]
+    assert json.loads(request["params"][0]) == {
+        "constraints": {"ids": [1, 2]},
+        "attachments": {"reviewers": True},
+        "__conduit__": {"token": "api-token"},
+    }
+
+
+def read_request(connection):
+    """Read an HTTP request from the socket, return its body."""
+    data = b""
+    while b"\r\n\r\n" not in data:
+        data += connection.recv(4096)
+    headers, body = data.split(b"\r\n\r\n", 1)
+    length = int(headers.lower().split(b"content-length:")[1].split(b"\r\n")[0])
+    while len(body) < length:
+        body += connection.recv(4096)
+    return body
+
+
+def test_conduit_client_retries_unanswered_requests():
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(5)
+    received = []
+    answer = b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok"
+
+    def serve():
+        # The first connection is closed while idle.
+        connection, _ = listener.accept()
+        received.append(read_request(connection))
+        connection.sendall(answer)
+        connection.close()
+        # The second one is closed after reading a request, half answered.
+        connection, _ = listener.accept()
+        received.append(read_request(connection))
+        connection.sendall(answer)
+        received.append(read_request(connection))
+        connection.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\no")
+        connection.close()
+
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    client = mozphab.ConduitClient(timeout=5)
+    url = "http://127.0.0.1:%s/api/differential.creatediff" % listener.getsockname()[1]
+
+    assert client.post(url, "1") == "ok"
+    assert client.post(url, "2") == "ok"
+    with pytest.raises(mozphab.httplib.IncompleteRead):
+        client.post(url, "3")
+    thread.join(5)
+    listener.close()
+    assert received == [b"1", b"2", b"3"]
+
+
+def test_get_revisions_attachments(tmpdir, monkeypatch):
+    monkeypatch.setattr(mozphab, "cache", mozphab.SimpleCache())
+    revision = {"id": 1, "phid": "PHID-DREV-1", "fields": {}, "attachments": {}}
+    tmpdir.join(".arcconfig").write('{"phabricator.uri": "https://phab.test/"}')
+    repo = mozphab.Repository(str(tmpdir), str(tmpdir))
+    repo.call_conduit = FakeConduit(revisions=[revision])
+
+    assert mozphab.get_revisions(repo, ids=[1], attachments=()) == [revision]
+    assert mozphab.get_revisions(repo, phids=["PHID-DREV-1"], attachments=()) == [
+        revision
+    ]
+    assert len(repo.call_conduit.calls) == 1
+    assert "attachments" not in repo.call_conduit.calls[0][1]
+
+    # The cached revision doesn't have the reviewers.
+    mozphab.get_revisions(repo, ids=[1])
+    assert len(repo.call_conduit.calls) == 2
+    assert repo.call_conduit.calls[1][1]["attachments"] == {"reviewers": True}
+
+
+def test_cache_scoped_to_phabricator(tmpdir, monkeypatch):
+    cache_file = str(tmpdir.join("cache.json"))
+    monkeypatch.setattr(
+        mozphab, "cache", mozphab.PersistentCache(cache_file, mozphab.CACHE_TTL, 10)
+    )
+    repos = []
+    for name in ("phab", "phab-dev"):
+        revision = {
+            "id": 1,
+            "phid": "PHID-DREV-%s" % name,
+            "fields": {},
+            "attachments": {"reviewers": {}},
+        }
+        repo = mozphab.Repository(
+            str(tmpdir), str(tmpdir), phab_url="https://%s.test/" % name
+        )
+        repo.call_conduit = FakeConduit(revisions=[revision])
+        repos.append(repo)
+
+    assert mozphab.get_revisions(repos[0], ids=[1])[0]["phid"] == "PHID-DREV-phab"
+    mozphab.cache.save()
+
+    # D1 of another instance isn't read from the file.
+    mozphab.cache = mozphab.PersistentCache(cache_file, mozphab.CACHE_TTL, 10)
+    assert mozphab.get_revisions(repos[1], ids=[1])[0]["phid"] == "PHID-DREV-phab-dev"
+    assert mozphab.get_revisions(repos[0], ids=[1])[0]["phid"] == "PHID-DREV-phab"
+    assert len(repos[0].call_conduit.calls) == 1
+    assert len(repos[1].call_conduit.calls) == 1
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Return a list holding the time seen by moz-phab, set it to move the clock."""
+    now = [1500000000.0]
+    monkeypatch.setattr(mozphab.time, "time", lambda: now[0])
+    return now
+
+
+def test_persistent_cache_expiry(tmpdir, clock):
+    cache_file = str(tmpdir.join("cache.json"))
+
+    def load():
+        return mozphab.PersistentCache(cache_file, mozphab.CACHE_TTL, 10)
+
+    cache = load()
+    cache.set("phab.test/rev-1", "revision")
+    cache.set("phab.test/user-active", "active")
+    # Away users are stored until they're back, if it's earlier than the TTL.
+    cache.set("phab.test/user-away", "away", expires=clock[0] + 60)
+    cache.set("phab.test/user-later", "later", expires=clock[0] + 24 * 60 * 60)
+    cache.set("phab.test/other", "not persisted")
+    cache.save()
+
+    def stored():
+        cache = load()
+        return sorted(
+            key
+            for key in (
+                "phab.test/rev-1",
+                "phab.test/user-active",
+                "phab.test/user-away",
+                "phab.test/user-later",
+                "phab.test/other",
+            )
+            if key in cache
+        )
+
+    assert stored() == [
+        "phab.test/rev-1",
+        "phab.test/user-active",
+        "phab.test/user-away",
+        "phab.test/user-later",
+    ]
+    clock[0] += 60
+    assert stored() == [
+        "phab.test/rev-1",
+        "phab.test/user-active",
+        "phab.test/user-later",
+    ]
+    clock[0] += 4 * 60
+    assert stored() == ["phab.test/user-active", "phab.test/user-later"]
+    clock[0] += 4 * 60 * 60
+    assert stored() == []
+
+    # Expired entries are dropped from the file by the next save.
+    cache = load()
+    cache.set("phab.test/project-1", "project")
+    cache.save()
+    with open(cache_file) as f:
+        assert json.load(f).keys() == ["phab.test/project-1"]
+
+
+def test_persistent_cache_evicts_least_recently_used(tmpdir, clock):
+    cache_file = str(tmpdir.join("cache.json"))
+    cache = mozphab.PersistentCache(cache_file, mozphab.CACHE_TTL, 3)
+    for i in range(4):
+        clock[0] += 1
+        cache.set("phab.test/rev-%s" % i, i)
+    cache.save()
+
+    # The oldest entry is dropped, reading an entry makes it the most recent one.
+    cache = mozphab.PersistentCache(cache_file, mozphab.CACHE_TTL, 3)
+    assert "phab.test/rev-0" not in cache
+    clock[0] += 1
+    assert cache.get("phab.test/rev-1") == 1
+    clock[0] += 1
+    cache.set("phab.test/rev-4", 4)
+    cache.save()
+
+    with open(cache_file) as f:
+        assert sorted(json.load(f)) == [
+            "phab.test/rev-1",
+            "phab.test/rev-3",
+            "phab.test/rev-4",
+        ]
+
+
+def test_persistent_cache_merges_saves(tmpdir, clock):
+    cache_file = str(tmpdir.join("cache.json"))
+    first = mozphab.PersistentCache(cache_file, mozphab.CACHE_TTL, 10)
+    second = mozphab.PersistentCache(cache_file, mozphab.CACHE_TTL, 10)
+    first.set("phab.test/rev-1", "first")
+    first.set("phab.test/rev-2", "first")
+    second.set("phab.test/rev-2", "second")
+    second.set("phab.test/rev-3", "second")
+    first.save()
+    second.save()
+    # Deleting an entry only removes this one from the file.
+    first.delete("phab.test/rev-1")
+    first.save()
+
+    cache = mozphab.PersistentCache(cache_file, mozphab.CACHE_TTL, 10)
+    assert cache.get("phab.test/rev-1") is None
+    assert cache.get("phab.test/rev-2") == "second"
+    assert cache.get("phab.test/rev-3") == "second"
+
+
+def test_diff_store_scoped_to_phabricator(tmpdir, monkeypatch):
+    monkeypatch.setattr(
+        mozphab, "diff_store", mozphab.DiffStore(str(tmpdir.join("store")), 1 << 20)
+    )
+    calls = []
+    repos = []
+    for url in ("https://phab.test/", "https://phab-dev.test:8443/"):
+        repo = mozphab.Repository(str(tmpdir), str(tmpdir), phab_url=url)
+        repo.call_conduit = lambda method, args, url=url: calls.append(url) or url
+        repos.append(repo)
+
+    # Diff 1 of another instance isn't read from the store.
+    for repo in repos + repos:
+        assert mozphab.get_raw_diff(repo, 1) == repo.phab_url
+    assert calls == ["https://phab.test/", "https://phab-dev.test:8443/"]
+
+
+def test_timing_trace(tmpdir, monkeypatch, conduit_repo, caplog):
+    trace_file = str(tmpdir.join("trace.json"))
+    monkeypatch.setattr(mozphab, "timing_trace", mozphab.TimingTrace())
+    monkeypatch.setattr(mozphab, "SHOW_SPINNER", False)
+    mozphab.timing_trace.filename = trace_file
+    caplog.set_level(logging.INFO)
+    cache = mozphab.PersistentCache(
+        str(tmpdir.join("cache.json")), mozphab.CACHE_TTL, 10
+    )
+    cache.set("user-someone", {})
+
+    with mozphab.wait_message("Searching"):
+        assert "user-someone" in cache
+        assert "user-nobody" not in cache
+        conduit_repo.call_conduit("differential.revision.search", {})
+        mozphab.check_output(["git", "--version"])
+    mozphab.timing_trace.save()
+
+    with open(trace_file) as f:
+        events = {e["name"]: e for e in json.load(f)["traceEvents"]}
+    phase = events["Searching"]
+    assert phase["cat"] == "phase"
+    conduit = events["differential.revision.search"]
+    assert conduit["args"]["phase"] == "Searching"
+    assert conduit["args"]["bytes_sent"] > conduit["args"]["bytes_received"] > 0
+    assert phase["ts"] <= conduit["ts"]
+    assert conduit["ts"] + conduit["dur"] <= phase["ts"] + phase["dur"]
+    command = events["git"]
+    assert command["args"]["command"] == "git --version"
+    assert command["args"]["status"] == 0
+    assert events["conduit cache"]["args"]["phase"] == "Searching"
+
+    summary = [" ".join(line.split()) for line in caplog.messages]
+    assert "cache conduit cache 2 1 hits, 1 misses" in summary
+    assert any(l.startswith("conduit differential.revision.search 1 ") for l in summary)
+    assert any(l.startswith("command git 1 ") for l in summary)
+
+
+def test_timing_trace_phases_per_thread(tmpdir, monkeypatch):
+    monkeypatch.setattr(mozphab, "timing_trace", mozphab.TimingTrace())
+    mozphab.timing_trace.filename = str(tmpdir.join("trace.json"))
+    cache = mozphab.PersistentCache(str(tmpdir.join("cache.json")), [], 10)
+    entered = threading.Event()
+    done = threading.Event()
+
+    def other():
+        with mozphab.timing_trace.phase("Other"):
+            entered.set()
+            done.wait()
+
+    thread = threading.Thread(target=other)
+    thread.start()
+    entered.wait()
+    assert "main" not in cache
+    done.set()
+    thread.join()
+    # The calls of parallel_map are a part of the caller's phase.
+    with mozphab.timing_trace.phase("Uploading"):
+        assert list(mozphab.parallel_map(cache.__contains__, ["a", "b"])) == [False] * 2
+
+    phases = dict(
+        (e["args"]["key"], e["args"].get("phase"))
+        for e in mozphab.timing_trace.events
+        if e["cat"] == "cache"
+    )
+    assert phases == {"main": None, "a": "Uploading", "b": "Uploading"}
+
+
+@pytest.fixture
+def phabricator(tmpdir):
+    """Return a running ConduitServer, and write an .arcconfig pointing to it."""
+    server = conduit_server.ConduitServer(api_token="api-token").start()
+    tmpdir.join(".arcconfig").write(
+        '{"phabricator.uri": "%s", "repository.callsign": "TEST"}' % server.url
+    )
+    yield server
+    server.stop()
+
+
+def test_get_revisions_from_server(tmpdir, monkeypatch, phabricator):
+    monkeypatch.setattr(mozphab, "cache", mozphab.SimpleCache())
+    phabricator.page_size = 10
+    ids = [phabricator.add_revision("Bug 1 - %s" % i)["id"] for i in range(25)]
+    repo = mozphab.Repository(str(tmpdir), str(tmpdir))
+    repo.load_api_token = lambda: "api-token"
+
+    revisions = mozphab.get_revisions(repo, ids=ids)
+    assert [r["id"] for r in revisions] == ids
+    assert revisions[0]["attachments"] == {"reviewers": {"reviewers": []}}
+    # Three pages, the revisions are cached then.
+    assert phabricator.calls == {"differential.revision.search": 3}
+    mozphab.get_revisions(repo, ids=ids)
+    assert phabricator.calls == {"differential.revision.search": 3}
+
+
+def test_submit_to_server(tmpdir, monkeypatch, phabricator):
+    monkeypatch.setattr(mozphab, "cache", mozphab.SimpleCache())
+    repo_phid = phabricator.add_repository("TEST")
+    phabricator.add_user("reviewer")
+    repo = mozphab.Repository(str(tmpdir), str(tmpdir))
+    repo.vcs = "git"
+    repo.load_api_token = lambda: "api-token"
+    diff = "diff --git a/f b/f\n--- a/f\n+++ b/f\n@@ -1 +1 @@\n-a\n+b\n"
+    repo.commit_diff = lambda node, context: {
+        "parent": "p" * 40,
+        "author-name": "Author",
+        "author-email": "author@example.com",
+        "author-time": 1500000000,
+        "diff": diff,
+    }
+    args = argparse.Namespace(lesscontext=False, wip=False, message=None)
+
+    urls = []
+    for i in range(2):
+        commit = {
+            "node": str(i) * 40,
+            "title-preview": "Bug 1 - Change %s r?reviewer" % i,
+            "body": "Body",
+            "bug-id": "1",
+            "reviewers": dict(request=["reviewer"], granted=[]),
+        }
+        url, diff_phid = mozphab.conduit_submit_commit(repo, commit, args)
+        urls.append(url)
+
+    assert urls == [phabricator.url + "D1", phabricator.url + "D2"]
+    # The repository is searched once, the reviewers are checked once.
+    assert phabricator.calls == {
+        "diffusion.repository.search": 1,
+        "user.query": 1,
+        "differential.creatediff": 2,
+        "differential.setdiffproperty": 2,
+        "differential.revision.edit": 2,
+    }
+    revision = list(phabricator.revisions.values())[1]
+    assert revision["fields"]["title"] == "Bug 1 - Change 1 r?reviewer"
+    assert revision["fields"]["diffPHID"] == diff_phid
+    assert revision["fields"]["repositoryPHID"] == repo_phid
+    reviewers = revision["attachments"]["reviewers"]["reviewers"]
+    assert [r["reviewerPHID"] for r in reviewers] == ["PHID-USER-reviewer"]
+    raw_diff = repo.call_conduit("differential.getrawdiff", {"diffID": 2})
+    assert mozphab.parse_git_diff(raw_diff) == mozphab.parse_git_diff(diff)
+    commits = mozphab.get_diffs(repo, [diff_phid])[diff_phid]["attachments"]["commits"]
+    assert commits["commits"][0]["author"]["email"] == "author@example.com"
+
+
+def test_server_form_requests_and_bugs(phabricator):
+    phabricator.latency = {"differential.revision.search": 0.1}
+    phabricator.add_revision("Bug 1 - First", bug_id=1)
+    request = urllib2.Request(
+        phabricator.api_url + "differential.revision.search",
+        "api.token=api-token&constraints[ids][0]=1&attachments[reviewers]=1",
+    )
+    started = time.time()
+    response = json.load(urllib2.urlopen(request))
+    assert time.time() - started >= 0.1
+    assert [r["fields"]["title"] for r in response["result"]["data"]] == [
+        "Bug 1 - First"
+    ]
+    assert phabricator.requests[-1][1] == {
+        "constraints": {"ids": ["1"]},
+        "attachments": {"reviewers": "1"},
+    }
+
+    request = urllib2.Request(
+        phabricator.api_url + "conduit.ping", "api.token=wrong-token"
+    )
+    assert json.load(urllib2.urlopen(request))["error_code"] == "ERR-INVALID-AUTH"
+    assert phabricator.calls["conduit.ping"] == 0
+
+    # Malformed calls get an error instead of breaking the connection.
+    for method, data in (
+        ("project.search", "api.token=api-token"),
+        ("conduit.ping", "params=not-json"),
+    ):
+        request = urllib2.Request(phabricator.api_url + method, data)
+        response = json.load(urllib2.urlopen(request))
+        assert response["error_code"] == "ERR-CONDUIT-CORE"
+
+    request = urllib2.Request(
+        phabricator.url + "rest/bug",
+        json.dumps({"product": "Firefox", "summary": "A bug"}),
+        {"Content-Type": "application/json"},
+    )
+    bug_id = json.load(urllib2.urlopen(request))["id"]
+    bug = json.load(urllib2.urlopen(phabricator.url + "rest/bug/%s" % bug_id))
+    assert bug["bugs"][0]["summary"] == "A bug"
+    assert phabricator.calls["bugzilla.bug.create"] == 1
@@ -0,0 +1,282 @@
+"""
+Git stack handling in moz-phab, run against scratch repositories.
+
+Requires `git` and Python 2.7 (moz-phab's runtime):
+
+    python2 -m pytest mozphab_git_test.py
+"""
+
+import argparse
+import imp
+import os
+import subprocess
+
+import pytest
+
+mozphab = imp.load_source(
+    "mozphab", os.path.join(os.path.dirname(__file__), "moz-phab")
+)
+
+pytestmark = pytest.mark.skipif(not mozphab.which("git"), reason="Git is not installed")
+
+
+def git(repo_path, *args):
+    return subprocess.check_output(["git"] + list(args), cwd=repo_path).strip()
+
+
+@pytest.fixture
+def make_repo(tmpdir, monkeypatch):
+    """Return a function creating a repository with a stack of commits on master."""
+    monkeypatch.setattr(mozphab, "config", mozphab.Config(should_access_file=False))
+
+    def make(stack_size):
+        path = str(tmpdir.mkdir("repo-%s" % stack_size))
+        git(path, "init", "-q")
+        git(path, "config", "user.name", "Test")
+        git(path, "config", "user.email", "test@example.com")
+        git(path, "checkout", "-q", "-b", "master")
+        with open(os.path.join(path, ".arcconfig"), "w") as f:
+            f.write('{"phabricator.uri": "https://phab.test/"}')
+        git(path, "add", ".")
+        git(path, "commit", "-q", "-m", "base")
+        base = git(path, "rev-parse", "HEAD")
+        for i in range(stack_size):
+            with open(os.path.join(path, "file"), "w") as f:
+                f.write("change %s\n" % i)
+            git(path, "add", ".")
+            git(path, "commit", "-q", "-m", "Bug 1 - change %s r?reviewer" % i)
+
+        repo = mozphab.Git(path)
+        repo.set_args(
+            argparse.Namespace(safe_mode=False, start_rev=base, end_rev="HEAD")
+        )
+        return repo
+
+    return make
+
+
+def titles(repo, rev):
+    return git(repo.path, "log", "--reverse", "--format=%s", rev).splitlines()
+
+
+@pytest.mark.parametrize("stale_ref", [False, True], ids=["clean", "stale-ref"])
+def test_amend_commits(make_repo, stale_ref):
+    repo = make_repo(4)
+    commits = repo.commit_stack()
+    # A branch pointing in the stack, and one with a commit on top of it.
+    git(repo.path, "branch", "middle", commits[1]["node"])
+    git(repo.path, "checkout", "-q", "-b", "side", commits[1]["node"])
+    with open(os.path.join(repo.path, "side"), "w") as f:
+        f.write("side\n")
+    git(repo.path, "add", ".")
+    git(repo.path, "commit", "-q", "-m", "side")
+    git(repo.path, "checkout", "-q", "master")
+    if stale_ref:
+        # Left behind by an interrupted run, not related to the stack.
+        git(repo.path, "update-ref", mozphab.REWRITE_REF, "side")
+
+    repo.before_submit()
+    commits[1]["title"] += " amended"
+    repo.amend_commit(commits[1], commits)
+    repo.finalize(commits)
+    repo.refresh_commit_stack(commits)
+
+    stack = [
+        "base",
+        "Bug 1 - change 0 r?reviewer",
+        "Bug 1 - change 1 r?reviewer amended",
+        "Bug 1 - change 2 r?reviewer",
+        "Bug 1 - change 3 r?reviewer",
+    ]
+    assert titles(repo, "master") == stack
+    log = git(repo.path, "log", "--reverse", "--format=%H", "master~4..")
+    assert [c["node"] for c in commits] == log.splitlines()
+    assert git(repo.path, "rev-parse", "middle") == commits[1]["node"]
+    assert titles(repo, "side") == stack[:3] + ["side"]
+    assert git(repo.path, "symbolic-ref", "HEAD") == "refs/heads/master"
+    assert git(repo.path, "status", "--porcelain") == ""
+    assert git(repo.path, "for-each-ref", mozphab.REWRITE_REF) == ""
+
+
+def test_amend_unchanged_commits(make_repo):
+    repo = make_repo(2)
+    commits = repo.commit_stack()
+    head = git(repo.path, "rev-parse", "HEAD")
+
+    repo.before_submit()
+    for commit in commits:
+        repo.amend_commit(commit, commits)
+    repo.finalize(commits)
+
+    assert git(repo.path, "rev-parse", "HEAD") == head
+
+
+@pytest.mark.parametrize(
+    "start,message",
+    [("base", "is not a child of"), ("HEAD^^", "Multiple parents found")],
+)
+def test_commit_stack_with_side_branch(make_repo, start, message):
+    repo = make_repo(2)
+    git(repo.path, "checkout", "-q", "-b", "side", repo.args.start_rev)
+    with open(os.path.join(repo.path, "side"), "w") as f:
+        f.write("side\n")
+    git(repo.path, "add", ".")
+    git(repo.path, "commit", "-q", "-m", "Bug 2 - side")
+    git(repo.path, "checkout", "-q", "master")
+    git(repo.path, "merge", "-q", "--no-ff", "-m", "Merge side", "side")
+    if start != "base":
+        # Only the merge commit has a parent outside of the range.
+        repo.args.start_rev = git(repo.path, "rev-parse", start)
+        repo.set_args(repo.args)
+
+    with pytest.raises(mozphab.Error, match=message):
+        repo.commit_stack()
+
+
+def test_config_snapshot(make_repo, monkeypatch):
+    monkeypatch.setattr(mozphab, "cache", mozphab.SimpleCache())
+    path = make_repo(1).path
+    config = os.path.join(path, ".git", "config")
+
+    def read_config():
+        return mozphab.parse_config(mozphab.Git(path)._read_config())
+
+    # Included files which don't exist yet, or whose condition isn't met.
+    with open(config, "a") as f:
+        f.write('[include]\n\tpath = missing\n[includeIf "onbranch:side"]\n')
+        f.write("\tpath = side\n")
+    with open(os.path.join(path, ".git", "side"), "w") as f:
+        f.write("[moz-phab]\n\tside = true\n")
+    assert "moz-phab.missing" not in read_config()
+    assert "moz-phab.side" not in read_config()
+
+    with open(os.path.join(path, ".git", "missing"), "w") as f:
+        f.write("[moz-phab]\n\tmissing = true\n")
+    assert read_config()["moz-phab.missing"] == "true"
+
+    git(path, "checkout", "-q", "-b", "side")
+    assert read_config()["moz-phab.side"] == "true"
+
+
+@pytest.mark.parametrize("jobs", [1, 2], ids=["sequential", "parallel"])
+def test_submit_failure_keeps_revisions(make_repo, monkeypatch, jobs):
+    repo = make_repo(3)
+    monkeypatch.setattr(mozphab, "SHOW_SPINNER", False)
+    monkeypatch.setattr(mozphab, "cache", mozphab.SimpleCache())
+    monkeypatch.setattr(
+        mozphab, "submit_preflight", lambda *args: dict(arc=True, conduit=True)
+    )
+    monkeypatch.setattr(mozphab, "resume_submit", lambda *args: None)
+    monkeypatch.setattr(mozphab, "show_commit_stack", lambda *args, **kwargs: None)
+    monkeypatch.setattr(repo, "check_commits_for_submit", lambda *args, **kw: None)
+
+    def upload_commit(repo, commit, args, **kwargs):
+        if commit["title"].startswith("Bug 1 - change 2"):
+            raise mozphab.Error("arc failed")
+        rev_id = int(commit["title"].split()[4]) + 1
+        return "https://phab.test/D%s" % rev_id, None, False
+
+    monkeypatch.setattr(mozphab, "upload_commit", upload_commit)
+    args = argparse.Namespace(
+        wip=False,
+        force=False,
+        message=None,
+        yes=True,
+        interactive=False,
+        no_stack=jobs > 1,
+        jobs=jobs,
+        reviewer=None,
+        blocker=None,
+        bug=None,
+    )
+
+    # The commits uploaded before the failure get their revision.
+    with pytest.raises(mozphab.Error):
+        mozphab.submit(repo, args)
+
+    log = git(repo.path, "log", "--reverse", "--format=%B%x00", "master~3..")
+    bodies = [b.strip() for b in log.split("\0")[:-1]]
+    assert bodies == [
+        "Bug 1 - change 0 r?reviewer\n\nDifferential Revision: https://phab.test/D1",
+        "Bug 1 - change 1 r?reviewer\n\nDifferential Revision: https://phab.test/D2",
+        "Bug 1 - change 2 r?reviewer",
+    ]
+
+
+def test_cat_file(make_repo):
+    repo = make_repo(1)
+    head = git(repo.path, "rev-parse", "HEAD")
+    # Enough objects for two of them to share the shortest abbreviation.
+    stream = "".join("blob\ndata %s\n%s\n" % (len(str(i)), i) for i in range(2000))
+    fast_import = subprocess.Popen(
+        ["git", "fast-import", "--quiet"], stdin=subprocess.PIPE, cwd=repo.path
+    )
+    fast_import.communicate(stream)
+    objects = git(
+        repo.path, "cat-file", "--batch-all-objects", "--batch-check=%(objectname)"
+    ).splitlines()
+    prefixes = [o[:4] for o in objects]
+    ambiguous = next(p for p in prefixes if prefixes.count(p) > 1)
+
+    assert repo.cat_file(head[:7]) == (head, "commit", None)
+    assert repo.cat_file("HEAD", contents=True)[2].startswith("tree ")
+    assert repo.cat_file("0" * 40) is None
+    assert repo.cat_file(ambiguous) is None
+    assert repo.cat_file("HEAD:file")[1] == "blob"
+    assert repo.is_node(head[:7])
+    assert not repo.is_node("0" * 40)
+    assert not repo.is_node("HEAD:file")
+    with pytest.raises(mozphab.NotFoundError):
+        repo._commit_message("HEAD^{tree}")
+    # One process of each kind answers all the lookups.
+    assert sorted(repo._cat_files) == ["--batch", "--batch-check"]
+
+
+def test_amend_commit_ignores_trailing_newlines(make_repo):
+    repo = make_repo(0)
+    git(repo.path, "commit", "-q", "--allow-empty", "--cleanup=verbatim")
+    git(
+        repo.path,
+        "commit",
+        "-q",
+        "--amend",
+        "--allow-empty",
+        "--cleanup=verbatim",
+        "-m",
+        "Bug 1 - title\n\nBody\n\n\n",
+    )
+    commit = dict(
+        node=git(repo.path, "rev-parse", "HEAD"),
+        name="HEAD",
+        title="Bug 1 - title",
+        body="\nBody",
+    )
+    assert repo._commit_message(commit["node"]) == "Bug 1 - title\n\nBody\n\n\n"
+
+    repo.amend_commit(commit, [commit])
+    assert repo._amended == set()
+
+    commit["body"] = "\nAnother body"
+    repo.amend_commit(commit, [commit])
+    assert repo._amended == set([commit["node"]])
+
+
+def test_hg2git_node_memoized(make_repo, monkeypatch):
+    repo = make_repo(1)
+    head = git(repo.path, "rev-parse", "HEAD")
+    repo.extensions.append("cinnabar")
+    calls = []
+    git_out = repo.git_out
+
+    def cinnabar_git_out(args, **kwargs):
+        if args[0] == "cinnabar":
+            calls.append(args)
+            return head
+        return git_out(args, **kwargs)
+
+    monkeypatch.setattr(repo, "git_out", cinnabar_git_out)
+
+    hg_node = "a" * 40
+    assert repo.check_node(hg_node) == head
+    assert repo.check_node(hg_node) == head
+    assert calls == [["cinnabar", "hg2git", hg_node]]
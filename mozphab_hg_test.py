@@ -0,0 +1,321 @@
+"""
+Mercurial stack handling in moz-phab, run against scratch repositories.
+
+Requires `hg` and Python 2.7 (moz-phab's runtime):
+
+    python2 -m pytest mozphab_hg_test.py
+"""
+
+import argparse
+import imp
+import os
+import subprocess
+
+import pytest
+
+mozphab = imp.load_source(
+    "mozphab", os.path.join(os.path.dirname(__file__), "moz-phab")
+)
+
+pytestmark = pytest.mark.skipif(
+    not mozphab.which("hg"), reason="Mercurial is not installed"
+)
+
+
+def hg(repo_path, *args):
+    return subprocess.check_output(["hg"] + list(args), cwd=repo_path)
+
+
+@pytest.fixture
+def make_repo(tmpdir, monkeypatch):
+    """Return a function creating a repository with a stack of draft commits."""
+    hgrc = tmpdir.join("hgrc")
+    hgrc.write("[ui]\nusername = Test <test@example.com>\n")
+    monkeypatch.setenv("HGRCPATH", str(hgrc))
+    monkeypatch.setattr(mozphab, "config", mozphab.Config(should_access_file=False))
+
+    def make(stack_size, evolve=False):
+        if evolve:
+            hgrc.write("[extensions]\nevolve =\n", mode="a")
+        path = tmpdir.mkdir("repo-%s" % stack_size)
+        hg(str(path), "init")
+        path.join(".arcconfig").write('{"phabricator.uri": "https://phab.test/"}')
+        path.join("file").write("base\n")
+        hg(str(path), "commit", "-A", "-m", "base")
+        hg(str(path), "phase", "--public", "-r", ".")
+        for i in range(stack_size):
+            path.join("file").write("change %s\n" % i)
+            hg(str(path), "commit", "-m", "Bug 1 - change %s r?reviewer" % i)
+
+        repo = mozphab.Mercurial(str(path))
+        repo.set_args(
+            argparse.Namespace(
+                safe_mode=False, start_rev="(auto)", end_rev=".", force_delete=False
+            )
+        )
+        return repo
+
+    return make
+
+
+@pytest.fixture
+def hg_calls(monkeypatch):
+    """Count the `hg` processes started by moz-phab."""
+    calls = []
+    check_call = mozphab.check_call
+    check_output = mozphab.check_output
+
+    def counting_check_call(command, **kwargs):
+        calls.append(command)
+        return check_call(command, **kwargs)
+
+    def counting_check_output(command, **kwargs):
+        calls.append(command)
+        return check_output(command, **kwargs)
+
+    monkeypatch.setattr(mozphab, "check_call", counting_check_call)
+    monkeypatch.setattr(mozphab, "check_output", counting_check_output)
+    return calls
+
+
+def count_calls(hg_calls, func, *args):
+    del hg_calls[:]
+    result = func(*args)
+    return len(hg_calls), result
+
+
+def test_commit_stack_calls_independent_of_stack_size(make_repo, hg_calls):
+    small = make_repo(2)
+    large = make_repo(8)
+
+    small_calls, small_commits = count_calls(hg_calls, small.commit_stack)
+    large_calls, large_commits = count_calls(hg_calls, large.commit_stack)
+
+    assert len(small_commits) == 2
+    assert len(large_commits) == 8
+    assert large_commits[0]["title"] == "Bug 1 - change 0 r?reviewer"
+    assert small_calls == large_calls == 1
+
+
+def test_refresh_commit_stack_calls_independent_of_stack_size(make_repo, hg_calls):
+    small = make_repo(2)
+    large = make_repo(8)
+    small_commits = small.commit_stack()
+    large_commits = large.commit_stack()
+
+    small_calls, _ = count_calls(hg_calls, small.refresh_commit_stack, small_commits)
+    large_calls, _ = count_calls(hg_calls, large.refresh_commit_stack, large_commits)
+
+    assert small_calls == large_calls == 1
+    assert large_commits[-1]["name"] == "8:%s" % large_commits[-1]["node"][:12]
+
+
+@pytest.fixture
+def command_server(monkeypatch):
+    monkeypatch.setattr(mozphab.config, "hg_command_server", True)
+
+
+def test_command_server_matches_subprocess(make_repo, command_server, hg_calls):
+    repo = make_repo(3)
+    del hg_calls[:]
+
+    commits = repo.commit_stack()
+    assert [c["title"] for c in commits] == [
+        "Bug 1 - change %s r?reviewer" % i for i in range(3)
+    ]
+    assert repo.hg_out(["log", "-T", "{desc}", "-r", "."], split=False) == hg(
+        repo.path, "log", "-T", "{desc}", "-r", "."
+    )
+    assert hg_calls == []
+
+    with pytest.raises(mozphab.CommandError) as e:
+        repo.hg_out(["log", "-r", "no-such-revision"])
+    assert e.value.status == 255
+
+    with pytest.raises(subprocess.CalledProcessError):
+        repo.hg(["update", "no-such-revision"])
+
+    # The server keeps working after failed commands and sees changes made by
+    # other processes.
+    hg(repo.path, "bookmark", "outside")
+    assert repo.hg_out(["bookmarks", "-T", "{bookmark}\n"]) == ["outside"]
+    assert hg_calls == []
+
+
+def test_command_server_falls_back_to_subprocess(make_repo, command_server, hg_calls):
+    repo = make_repo(2)
+    # Restart the server with a command it can't be started with.
+    repo._command_server.close()
+    repo._command_server.hg_command = ["hg", "--no-such-option"]
+    del hg_calls[:]
+
+    assert len(repo.commit_stack()) == 2
+    assert not repo._command_server.available
+    assert len(hg_calls) == 1
+
+
+def repo_file(repo, name):
+    path = os.path.join(repo.path, name)
+    with open(path, "w") as f:
+        f.write("%s\n" % name)
+    return path
+
+
+def has_evolve():
+    return not subprocess.call(
+        ["hg", "--config", "extensions.evolve=", "help", "-e", "evolve"],
+        stdout=open(os.devnull, "w"),
+        stderr=subprocess.STDOUT,
+    )
+
+
+@pytest.mark.parametrize("evolve", [False, True], ids=["obsstore", "evolve"])
+def test_amend_commits(make_repo, hg_calls, evolve):
+    if evolve and not has_evolve():
+        pytest.skip("evolve is not installed")
+
+    repo = make_repo(4, evolve=evolve)
+    # A commit based on the stack, but not a part of it.
+    hg(repo.path, "update", "-r", "2")
+    hg(repo.path, "commit", "-A", "-m", "side", str(repo_file(repo, "side")))
+    hg(repo.path, "update", "-r", "4")
+    repo.args.force_delete = True
+
+    commits = repo.commit_stack()
+    del hg_calls[:]
+    for commit in commits[1:3]:
+        commit["title"] += " amended"
+        repo.amend_commit(commit, commits)
+    repo.finalize(commits)
+    repo.cleanup()
+    repo.refresh_commit_stack(commits)
+
+    stack = "::%s" % commits[-1]["node"]
+    log = hg(repo.path, "log", "-T", "{desc|firstline}\n", "-r", stack)
+    assert log.splitlines() == [
+        "base",
+        "Bug 1 - change 0 r?reviewer",
+        "Bug 1 - change 1 r?reviewer amended",
+        "Bug 1 - change 2 r?reviewer amended",
+        "Bug 1 - change 3 r?reviewer",
+    ]
+    assert [c["node"] for c in commits] == hg(
+        repo.path, "log", "-T", "{node}\n", "-r", "%s - 0" % stack
+    ).splitlines()
+    children = "children(%s)" % commits[1]["node"]
+    assert "side" in hg(repo.path, "log", "-T", "{desc}\n", "-r", children).split("\n")
+    assert hg(repo.path, "log", "-T", "{rev}\n", "-r", "orphan()") == ""
+
+    if not evolve:
+        # All commits are rewritten at once, then the side commit is rebased.
+        commands = [c[c.index("--config") + 2 * c.count("--config")] for c in hg_calls]
+        assert commands.count("import") == 1
+        assert commands.count("rebase") == 1
+        assert hg(repo.path, "log", "--hidden", "-T", "{rev}\n").count("\n") == 6
+
+
+def test_amend_commits_restoring_descriptions(make_repo):
+    repo = make_repo(3)
+    repo.args.force_delete = True
+    commits = repo.commit_stack()
+    nodes = [c["node"] for c in commits]
+    titles = [c["title"] for c in commits]
+
+    # Restoring the descriptions imports the original commits again, unchanged.
+    for suffix in (" amended", "", " amended again", ""):
+        for commit, title in zip(commits[1:], titles[1:]):
+            commit["title"] = title + suffix
+            repo.amend_commit(commit, commits)
+        repo.finalize(commits)
+        stack = "::%s - 0" % commits[-1]["node"]
+        log = hg(repo.path, "log", "-T", "{node} {desc}\n", "-r", stack)
+        assert log.splitlines() == ["%s %s" % (c["node"], c["title"]) for c in commits]
+    repo.cleanup()
+
+    assert [c["node"] for c in commits] == nodes
+    log = hg(repo.path, "log", "--hidden", "-T", "{node} {desc}\n", "-r", "1:")
+    assert log.splitlines() == ["%s %s" % n for n in zip(nodes, titles)]
+
+
+def test_worktree(make_repo):
+    repo = make_repo(2)
+    first = repo.commit_stack()[0]["node"]
+
+    path = repo.add_worktree(first)
+    assert hg(path, "log", "-T", "{node}", "-r", ".") == first
+    assert hg(repo.path, "log", "-T", "{rev}", "-r", ".") == "2"
+    repo.remove_worktree(path)
+    assert not os.path.exists(path)
+
+
+def test_apply_patches(make_repo, hg_calls):
+    repo = make_repo(1)
+    author = b"Ann\xc3\xa9e <author@example.com>".decode("utf8")
+    diffs = [
+        "diff --git a/file b/file\n--- a/file\n+++ b/file\n@@ -1 +1 @@\n"
+        "-change 0\n+first\n",
+        "diff --git a/new b/new\nnew file mode 100644\n--- /dev/null\n+++ b/new\n"
+        "@@ -0,0 +1 @@\n+second\n",
+    ]
+    bodies = [
+        "Bug 1 - First\n\nFrom the summary\n\nDifferential Revision: x",
+        "Bug 1 - Second by %s\n\nDifferential Revision: y" % author,
+    ]
+    del hg_calls[:]
+
+    repo.apply_patches(
+        {"diff": diff, "body": body, "author": author, "author-date": 1500000000 + i}
+        for i, (diff, body) in enumerate(zip(diffs, bodies))
+    )
+
+    assert hg_calls == []
+    log = hg(repo.path, "log", "-T", r"{author}\0{date|hgdate}\0{desc}\1", "-r", "2:")
+    commits = [c.split("\0") for c in log.split("\1")[:-1]]
+    assert [c[0].decode("utf8") for c in commits] == [author, author]
+    assert [int(c[1].split()[0]) for c in commits] == [1500000000, 1500000001]
+    assert [c[2].decode("utf8") for c in commits] == bodies
+    assert hg(repo.path, "cat", "-r", ".", "file", "new") == "first\nsecond\n"
+
+
+def test_config_snapshot(make_repo, hg_calls, monkeypatch):
+    monkeypatch.setattr(mozphab, "cache", mozphab.SimpleCache())
+    path = make_repo(1).path
+    hgrc = os.path.join(path, ".hg", "hgrc")
+
+    def set_args():
+        del hg_calls[:]
+        repo = mozphab.Mercurial(path)
+        repo.set_args(argparse.Namespace(safe_mode=False))
+        return repo
+
+    # The configuration is read again only once a file it's read from changes.
+    assert not set_args().has_shelve
+    assert hg_calls == []
+
+    with open(hgrc, "a") as f:
+        f.write("[extensions]\nshelve =\n")
+    assert set_args().has_shelve
+    assert len(hg_calls) == 2
+
+    include = os.path.join(path, "included.rc")
+    with open(include, "w") as f:
+        f.write("[extensions]\nmq =\n")
+    with open(hgrc, "a") as f:
+        f.write("%%include %s\n" % include)
+    assert set_args().has_mq
+    assert set_args().has_mq
+    assert hg_calls == []
+
+    with open(include, "w") as f:
+        f.write("[extensions]\n")
+    assert not set_args().has_mq
+
+    # Creating an included file which didn't exist changes the configuration.
+    with open(hgrc, "a") as f:
+        f.write("%include missing.rc\n")
+    assert not set_args().has_mq
+    assert not set_args().has_mq
+    assert hg_calls == []
+    with open(os.path.join(path, ".hg", "missing.rc"), "w") as f:
+        f.write("[extensions]\nmq =\n")
+    assert set_args().has_mq
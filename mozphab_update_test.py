@@ -0,0 +1,120 @@
+"""
+Update checks of moz-phab and arc, run in the background.
+
+    python2 -m pytest mozphab_update_test.py
+"""
+
+import imp
+import json
+import os
+import time
+
+import pytest
+
+mozphab = imp.load_source(
+    "mozphab", os.path.join(os.path.dirname(__file__), "moz-phab")
+)
+
+
+@pytest.fixture
+def updater(tmpdir, monkeypatch):
+    """Record the update checks started and run instead of reaching the network."""
+    state_file = str(tmpdir.join("update-state.json"))
+    monkeypatch.setattr(mozphab, "UPDATE_STATE_FILE", state_file)
+    monkeypatch.setattr(mozphab, "UPDATE_LOCK_FILE", state_file + ".lock")
+    monkeypatch.setattr(mozphab, "config", mozphab.Config(should_access_file=False))
+
+    calls = []
+
+    def popen(command, **kwargs):
+        calls.append(command[-1])
+
+    def get_self_release():
+        calls.append("github")
+        return dict(published_at=time.time() + 60, tag="1.0", update_required=True)
+
+    def fetch_arc_repos():
+        calls.append("arc")
+        raise mozphab.CommandError("command 'git' failed to complete successfully")
+
+    def update_arc_repos(fetched=False):
+        calls.append("arc update" if fetched else "arc pull")
+
+    monkeypatch.setattr(mozphab.subprocess, "Popen", popen)
+    monkeypatch.setattr(mozphab, "get_self_release", get_self_release)
+    monkeypatch.setattr(mozphab, "fetch_arc_repos", fetch_arc_repos)
+    monkeypatch.setattr(mozphab, "update_arc_repos", update_arc_repos)
+    return calls
+
+
+def test_check_for_updates_in_background(updater, caplog):
+    # The first run only starts the checks.
+    mozphab.check_for_updates()
+    assert updater == ["update-check"]
+    assert "now available" not in caplog.text
+
+    del updater[:]
+    mozphab.update_check(None)
+    assert updater == ["github", "arc"]
+    with open(mozphab.UPDATE_STATE_FILE) as f:
+        state = json.load(f)
+    assert state["self"]["tag"] == "1.0"
+    assert "git" in state["arc"]["error"]
+
+    # The next runs read the results, and don't check again until it's due.
+    del updater[:]
+    mozphab.check_for_updates()
+    mozphab.update_check(None)
+    assert updater == []
+    assert "Version 1.0 of `moz-phab` is now available" in caplog.text
+
+    mozphab.config.arc_last_check = -1
+    state["self"]["checked"] -= mozphab.SELF_UPDATE_FREQUENCY * 60 * 60 + 1
+    state["arc"]["checked"] = 0
+    mozphab.write_json_atomic(mozphab.UPDATE_STATE_FILE, state)
+    mozphab.check_for_updates()
+    mozphab.update_check(None)
+    assert updater == ["update-check", "github"]
+
+
+def test_update_check_runs_once(updater):
+    # A check is running: no other is started, and a check started anyway stops.
+    with mozphab.file_lock(mozphab.UPDATE_LOCK_FILE) as locked:
+        assert locked
+        mozphab.check_for_updates()
+        mozphab.update_check(None)
+    assert updater == []
+    assert mozphab.read_update_state() == {}
+
+
+def test_arc_updated_in_foreground(updater, monkeypatch):
+    monkeypatch.setattr(mozphab, "fetch_arc_repos", lambda: ["arcanist"])
+    mozphab.config.self_last_check = -1
+
+    # The check running in the background only fetches the new commits.
+    mozphab.update_check(None)
+    assert updater == []
+    assert mozphab.read_update_state()["arc"]["pending"] == ["arcanist"]
+
+    # They're applied by the next command, unless the update check is running.
+    with mozphab.file_lock(mozphab.UPDATE_LOCK_FILE) as locked:
+        assert locked
+        mozphab.check_for_updates()
+    assert updater == []
+
+    mozphab.check_for_updates()
+    mozphab.check_for_updates()
+    assert updater == ["arc update"]
+    assert mozphab.read_update_state()["arc"]["pending"] == []
+
+
+def test_update_check_not_traced(updater, monkeypatch):
+    monkeypatch.setenv("MOZPHAB_TRACE_TIMING", "trace.json")
+    envs = []
+    monkeypatch.setattr(
+        mozphab.subprocess, "Popen", lambda command, env, **kwargs: envs.append(env)
+    )
+
+    mozphab.check_for_updates()
+    (env,) = envs
+    assert "MOZPHAB_TRACE_TIMING" not in env
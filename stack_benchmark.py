@@ -0,0 +1,286 @@
+"""
+Time the stack handling of moz-phab on synthetic git and Mercurial repositories.
+
+Each repository gets a public history, a stack of draft commits on top of it, and
+many branches forked off the stack base.  The time needed by the operations run on
+the stack, and the number of processes they start, should not depend on the
+history length or the number of branches.  Conduit calls are answered locally.
+
+The results can be saved as JSON and compared with a previous run:
+
+    python2 stack_benchmark.py --branches 5000 --stack 20 --output before.json
+    python2 stack_benchmark.py --branches 5000 --stack 20 --compare before.json
+"""
+
+import argparse
+import imp
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+
+mozphab = imp.load_source(
+    "mozphab", os.path.join(os.path.dirname(os.path.abspath(__file__)), "moz-phab")
+)
+
+REVIEWERS = 3
+
+
+def stack_message(i):
+    return "Bug %s - change %s r?reviewer%s" % (i + 1, i, i % REVIEWERS)
+
+
+def fast_import_stream(history, branches, stack):
+    """Yield a `git fast-import` stream building the synthetic repository."""
+    timestamp = 1500000000
+    for i in range(history + stack):
+        message = "commit %s\n" % i if i < history else stack_message(i - history)
+        yield "commit refs/heads/master\n"
+        yield "mark :%s\n" % (i + 1)
+        yield "committer Bench <bench@example.com> %s +0000\n" % (timestamp + i)
+        yield "data %s\n%s" % (len(message), message)
+        if i:
+            yield "from :%s\n" % i
+        content = "line %s\n" % i
+        yield "M 100644 inline file\ndata %s\n%s\n" % (len(content), content)
+
+    # The published history.
+    yield "reset refs/remotes/origin/master\nfrom :%s\n\n" % history
+
+    # Feature branches forked off the stack base, each with a commit of its own.
+    # They all show up in a `git rev-list --all` which stops at the stack base.
+    for i in range(branches):
+        message = "branch %s\n" % i
+        yield "commit refs/heads/branch-%s\n" % i
+        yield "committer Bench <bench@example.com> %s +0000\n" % timestamp
+        yield "data %s\n%s" % (len(message), message)
+        yield "from :%s\n" % history
+        yield "M 100644 inline branch-%s\ndata 0\n\n" % i
+
+
+def make_git_repo(path, history, branches, stack):
+    subprocess.check_call(["git", "init", "-q", path])
+    fast_import = subprocess.Popen(
+        ["git", "fast-import", "--quiet"], stdin=subprocess.PIPE, cwd=path
+    )
+    for chunk in fast_import_stream(history, branches, stack):
+        fast_import.stdin.write(chunk.encode("utf-8"))
+    fast_import.stdin.close()
+    if fast_import.wait():
+        raise Exception("git fast-import failed")
+
+    for command in (
+        ["checkout", "-q", "master"],
+        ["config", "user.name", "Bench"],
+        ["config", "user.email", "bench@example.com"],
+        ["remote", "add", "origin", "https://example.com/repo"],
+        ["symbolic-ref", "refs/remotes/origin/HEAD", "refs/remotes/origin/master"],
+    ):
+        subprocess.check_call(["git"] + command, cwd=path)
+
+
+def make_hg_repo(path, history, branches, stack):
+    def hg(*args):
+        subprocess.check_call(["hg"] + list(args), cwd=path)
+
+    os.mkdir(path)
+    hg("init")
+    # The history and the branches, empty commits.
+    hg("debugbuilddag", "+%s:base %s" % (history, " ".join(["<base +1"] * branches)))
+    hg("phase", "--public", "-r", "base")
+    hg("update", "-q", "base")
+    for i in range(stack):
+        with open(os.path.join(path, "file"), "w") as f:
+            f.write("line %s\n" % i)
+        hg("commit", "-q", "-A", "-m", stack_message(i))
+
+
+class FakeConduit(object):
+    """Answers the `user.query` calls made to validate the reviewers."""
+
+    def __call__(self, method, args):
+        assert method == "user.query", method
+        return [
+            {"userName": name, "phid": "PHID-USER-%s" % name, "currentStatus": None}
+            for name in args["usernames"]
+        ]
+
+
+@contextmanager
+def counting_processes():
+    """Count the processes started through the subprocess module."""
+    counter = dict(processes=0)
+    popen = subprocess.Popen
+
+    class CountingPopen(popen):
+        def __init__(self, *args, **kwargs):
+            counter["processes"] += 1
+            super(CountingPopen, self).__init__(*args, **kwargs)
+
+    subprocess.Popen = CountingPopen
+    try:
+        yield counter
+    finally:
+        subprocess.Popen = popen
+
+
+def timed(func, repeat, setup=None):
+    """Return the best time of `repeat` calls in milliseconds, and the number of
+    processes started by a call.
+    """
+    best = None
+    for _ in range(repeat):
+        if setup:
+            setup()
+        with counting_processes() as counter:
+            started = time.time()
+            func()
+            elapsed = (time.time() - started) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return dict(ms=round(best, 1), processes=counter["processes"])
+
+
+def benchmark(vcs, path, repeat):
+    """Return the results of the operations run on the repository."""
+    repo_class = mozphab.Git if vcs == "git" else mozphab.Mercurial
+    args = argparse.Namespace(
+        safe_mode=False,
+        start_rev="(auto)",
+        end_rev="HEAD" if vcs == "git" else ".",
+        force_delete=True,
+        force=False,
+        upstream=None,
+    )
+    state = {}
+
+    def set_args():
+        state["repo"] = repo_class(path)
+        state["repo"].set_args(args)
+
+    results = {"set_args": timed(set_args, repeat)}
+    repo = state["repo"]
+    repo.call_conduit = FakeConduit()
+    if vcs == "git":
+        results["_get_first_unpublished_node"] = timed(
+            repo._get_first_unpublished_node, repeat
+        )
+
+    results["commit_stack"] = timed(repo.commit_stack, repeat)
+    commits = repo.commit_stack()
+    mozphab.augment_commits_from_body(commits)
+
+    def forget_reviewers():
+        for i in range(REVIEWERS):
+            mozphab.cache.delete(mozphab.phab_cache_key(repo, "user-reviewer%s" % i))
+
+    results["check_commits_for_submit"] = timed(
+        lambda: repo.check_commits_for_submit(commits),
+        repeat,
+        setup=forget_reviewers,
+    )
+
+    # Every commit of the stack is amended, with a title of its own in each round.
+    repo.before_submit()
+    titles = [commit["title"] for commit in commits]
+
+    def amend():
+        state["round"] = state.get("round", 0) + 1
+        for commit, title in zip(commits, titles):
+            commit["title"] = "%s (amend %s)" % (title, state["round"])
+            repo.amend_commit(commit, commits)
+        repo.finalize(commits)
+
+    # The commits replaced by the previous round are stripped from hg in between.
+    results["amend_commit"] = timed(
+        amend, repeat, setup=repo.cleanup if vcs == "hg" else None
+    )
+    results["refresh_commit_stack"] = timed(
+        lambda: repo.refresh_commit_stack(commits), repeat
+    )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--vcs", nargs="+", choices=["git", "hg"], default=["git", "hg"]
+    )
+    parser.add_argument("--branches", type=int, default=1000)
+    parser.add_argument("--history", type=int, default=2000)
+    parser.add_argument("--stack", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", metavar="FILE", help="Save the results as JSON")
+    parser.add_argument(
+        "--compare", metavar="FILE", help="Compare with the results saved before"
+    )
+    args = parser.parse_args()
+
+    mozphab.config = mozphab.Config(should_access_file=False)
+    tmp = tempfile.mkdtemp(prefix="moz-phab-bench-")
+    mozphab.cache = mozphab.PersistentCache(
+        os.path.join(tmp, "cache.json"), mozphab.CACHE_TTL, mozphab.CACHE_MAX_ENTRIES
+    )
+    hgrc = os.path.join(tmp, "hgrc")
+    with open(hgrc, "w") as f:
+        f.write("[ui]\nusername = Bench <bench@example.com>\n")
+    os.environ["HGRCPATH"] = hgrc
+
+    results = {}
+    try:
+        for vcs in args.vcs:
+            path = os.path.join(tmp, vcs)
+            make_repo = make_git_repo if vcs == "git" else make_hg_repo
+            make_repo(path, args.history, args.branches, args.stack)
+            with open(os.path.join(path, ".arcconfig"), "w") as f:
+                f.write('{"phabricator.uri": "https://phab.test/"}')
+            for operation, result in benchmark(vcs, path, args.repeat).items():
+                results["%s %s" % (vcs, operation)] = result
+    finally:
+        shutil.rmtree(tmp)
+
+    parameters = dict(
+        history=args.history,
+        branches=args.branches,
+        stack=args.stack,
+        repeat=args.repeat,
+    )
+    print(
+        "%(history)s commits of history, %(branches)s branches, stack of %(stack)s"
+        % parameters
+    )
+    previous = {}
+    if args.compare:
+        with open(args.compare) as f:
+            saved = json.load(f)
+        previous = saved["results"]
+        if saved["parameters"] != parameters:
+            print(
+                "compared with %(history)s commits of history, %(branches)s "
+                "branches, stack of %(stack)s, %(repeat)s repeats" % saved["parameters"]
+            )
+    print("%-36s %10s %10s %16s" % ("", "ms", "processes", "previous ms"))
+    for name, result in sorted(results.items()):
+        line = "%-36s %10.1f %10d" % (name, result["ms"], result["processes"])
+        if name in previous:
+            line += " %10.1f %4.1fx" % (
+                previous[name]["ms"],
+                result["ms"] / max(previous[name]["ms"], 0.1),
+            )
+        print(line)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                dict(parameters=parameters, results=results),
+                f,
+                indent=2,
+                separators=(",", ": "),
+                sort_keys=True,
+            )
+
+
+if __name__ == "__main__":
+    main()